@@ -31,6 +31,8 @@ def parse_args():
                         help='skip number.')
     parser.add_argument('--gpu', type=str, default='0',
                         help='Set CUDA_VISIBLE_DEVICES')
+    parser.add_argument('--save_rows', type=int, default=0,
+                        help='Save per-row results of each run (see utils/significance.py for paired tests).')
     return parser.parse_args()
 
 
@@ -88,6 +90,8 @@ def main():
                     command += ' --random_seed ' + str(i)
                 if command.find(' --gpu ') == -1:
                     command += ' --gpu ' + args.gpu
+                if args.save_rows and command.find(' --save_rows') == -1:
+                    command += ' --save_rows 1'
                 if '${random_seed}' in command:
                     command = command.replace('${random_seed}', str(i))
                 print(command)
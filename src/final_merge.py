@@ -2,9 +2,10 @@ import pandas as pd
 import pickle
 import os
 import numpy as np
-import random
 import ast
 
+from utils import sampling
+
 # ==================== 📂 路径配置 ====================
 # 1. Agent4Rec 的基准数据目录
 BASE_DATA_DIR = r'../Agent4Rec-master/datasets/ml-1m/cf_data'
@@ -14,6 +15,9 @@ PKL_FOLDER_PATH = r'..\Agent4Rec-master\storage\ml-1m\LightGCN\lgn_1000_5_4_1009
 
 # 3. ReChorus 的数据根目录
 RECHORUS_DATA_ROOT = '../data'
+
+# 4. 负采样随机种子 (固定种子，保证每次生成的 dev/test 负样本一致)
+RANDOM_SEED = 0
 # ====================================================
 
 def read_cf_txt(filepath):
@@ -80,42 +84,42 @@ def parse_agent_viewed_data(folder_path):
 def generate_negative_samples(df_target, global_history, all_items, num_neg=99):
     """
     核心函数：为测试集/验证集的每一行生成 99 个负样本
+    向量化实现：批量采样候选，用排序索引一次性排除看过的物品，只重采冲突/重复的位置
+    不会修改 global_history，返回 int32 的 [n_rows, num_neg] 矩阵
     """
-    print(f"🎲 正在为 {len(df_target)} 条数据生成 99 个负样本 (这可能需要几秒钟)...")
-    
-    neg_lists = []
-    all_items_list = list(all_items) # 转成列表以便采样
-    
-    for idx, row in df_target.iterrows():
-        u = row['user_id']
-        i = row['item_id']
-        
-        # 该用户看过的所有电影 (Train + Valid + Test + AgentHistory)
-        seen = global_history.get(u, set())
-        # 还要加上当前这一条测试数据的 item (防止漏掉)
-        seen.add(i)
-        
-        samples = []
-        while len(samples) < num_neg:
-            candidates = random.sample(all_items_list, min(len(all_items_list), num_neg * 2))
-            for cand in candidates:
-                if cand not in seen and cand not in samples:
-                    samples.append(cand)
-                    if len(samples) == num_neg:
-                        break
-        
-        # 转成字符串格式 "[1, 2, 3]" 方便 csv 保存
-        neg_lists.append(str(samples))
-        
-    return neg_lists
-
-def save_to_folder(df_train, df_valid, df_test, folder_name):
+    print(f"🎲 正在为 {len(df_target)} 条数据生成 {num_neg} 个负样本...")
+    
+    pool = np.array(sorted(all_items), dtype=np.int64) # 候选物品池
+    users = df_target['user_id'].to_numpy(dtype=np.int64)
+    items = df_target['item_id'].to_numpy(dtype=np.int64)
+    
+    # 该用户看过的所有电影 (Train + Valid + Test + AgentHistory) 的排序索引
+    n_rows = int(max(max(global_history, default=0), users.max(initial=0))) + 1
+    n_cols = int(max(max((max(h) for h in global_history.values() if len(h)), default=0),
+                     pool.max(initial=0), items.max(initial=0))) + 1
+    seen = sampling.CSRIndex(global_history, n_rows, n_cols)
+    
+    # 冲突：看过的物品，或当前这一条测试数据的 item (防止漏掉)
+    collide = lambda rows, cands: seen.contains(users[rows], cands) | (cands == items[rows])
+    draw = lambda size: pool[np.random.randint(len(pool), size=size)]
+    # 可选物品不足 num_neg 的行会让拒绝采样永不结束，采样前检查并报错
+    n_available = sampling.count_available(seen, users, pool, items)
+    neg_items = sampling.reject_sample_unique(np.arange(len(df_target)), num_neg, draw, collide, n_available)
+    return neg_items.astype(np.int32)
+
+def save_to_folder(df_train, df_valid, df_test, folder_name, neg_valid=None, neg_test=None):
     target_dir = os.path.join(RECHORUS_DATA_ROOT, folder_name)
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
         
     print(f"💾 保存数据集到: {target_dir}")
     
+    # 保存负样本矩阵 (二进制，行与 dev.csv / test.csv 一一对应)
+    if neg_valid is not None:
+        np.save(os.path.join(target_dir, 'dev_neg_items.npy'), neg_valid)
+    if neg_test is not None:
+        np.save(os.path.join(target_dir, 'test_neg_items.npy'), neg_test)
+    
     # 保存 Train (不需要负样本)
     df_train = df_train[['user_id', 'item_id', 'time']]
     df_train.to_csv(os.path.join(target_dir, 'train.csv'), sep='\t', index=False, header=['user_id', 'item_id', 'time'])
@@ -202,12 +206,13 @@ def main():
 
     # 4. 为 Dev 和 Test 生成负样本 (计算量较大，做一次即可)
     print("\n🎲 [Step 4] 生成负样本 (99个/条)...")
+    np.random.seed(RANDOM_SEED)
     neg_valid = generate_negative_samples(df_valid_orig, global_history, all_items)
     neg_test = generate_negative_samples(df_test_orig, global_history, all_items)
     
-    # 将负样本挂载到 DataFrame
-    df_valid_orig['neg_items'] = neg_valid
-    df_test_orig['neg_items'] = neg_test
+    # 将负样本挂载到 DataFrame (转成字符串格式 "[1, 2, 3]" 方便 csv 保存)
+    df_valid_orig['neg_items'] = [str(x) for x in neg_valid.tolist()]
+    df_test_orig['neg_items'] = [str(x) for x in neg_test.tolist()]
     
     # 补充 time 列
     df_train_orig['time'] = 1
@@ -217,7 +222,7 @@ def main():
 
     # 5. 保存 Baseline
     print("\n📦 [Step 5] 保存 Baseline 数据集...")
-    save_to_folder(df_train_orig, df_valid_orig, df_test_orig, 'AgentRec_Original')
+    save_to_folder(df_train_orig, df_valid_orig, df_test_orig, 'AgentRec_Original', neg_valid, neg_test)
 
     # 6. 保存 Enhanced
     print("\n📦 [Step 6] 保存 Enhanced 数据集...")
@@ -226,7 +231,7 @@ def main():
     df_train_enhanced.drop_duplicates(subset=['user_id', 'item_id'], inplace=True)
     
     # Dev 和 Test 保持不变 (包含刚才生成的 neg_items)
-    save_to_folder(df_train_enhanced, df_valid_orig, df_test_orig, 'AgentRec_Enhanced')
+    save_to_folder(df_train_enhanced, df_valid_orig, df_test_orig, 'AgentRec_Enhanced', neg_valid, neg_test)
 
     print("\n🎉 完美解决！现在 dev.csv 和 test.csv 里面包含了真实的 99 个负样本列表。")
     print("格式示例: \"[120, 45, 999, ...]\"")
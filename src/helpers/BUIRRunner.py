@@ -5,7 +5,6 @@ import gc
 import torch
 import torch.nn as nn
 import logging
-import numpy as np
 from time import time
 from tqdm import tqdm
 from torch.utils.data import DataLoader
@@ -20,19 +19,21 @@ class BUIRRunner(BaseRunner):
         model = dataset.model
         if model.optimizer is None:
             model.optimizer = self._build_optimizer(model)
-        dataset.actions_before_epoch()  # must sample before multi thread start
+        self._compile_model(model)
+        self._actions_before_epoch(dataset)  # must sample before multi thread start
 
         model.train()
         loss_lst = list()
-        dl = DataLoader(dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers,
+        dl = DataLoader(dataset, batch_size=self._train_batch_size(), shuffle=True, num_workers=self.num_workers,
                         collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
         for batch in tqdm(dl, leave=False, desc='Epoch {:<3}'.format(epoch), ncols=100, mininterval=1):
             batch = utils.batch_to_gpu(batch, model.device)
             model.optimizer.zero_grad()
-            out_dict = model(batch)
-            loss = model.loss(out_dict)
+            with self._autocast(model.device):
+                out_dict = model(batch)
+            loss = self._model_loss(model, out_dict)
             loss.backward()
-            model.optimizer.step()
+            self._optimizer_step(model)
             model._update_target()
             loss_lst.append(loss.detach().cpu().data.numpy())
-        return np.mean(loss_lst).item()
+        return self._epoch_loss(loss_lst)
@@ -2,17 +2,34 @@
 
 import os
 import gc
+import copy
 import torch
+import datetime
+import shutil
+import tempfile
+import contextlib
 import torch.nn as nn
+import torch.nn.functional as F
 import logging
 import numpy as np
+import multiprocessing as mp
+import torch.distributed as dist
 from time import time
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from torch.utils.data import DataLoader
 from typing import Dict, List
 
 from utils import utils
-from models.BaseModel import BaseModel
+from utils import sampling
+from utils import optimizers
+from utils import distributed
+from utils import checkpoint
+from utils import significance
+from utils import pred_cache
+from utils.prefetch import EpochPrefetcher
+from utils.metrics import RankAccumulator, rank_metric_rows
+from models.BaseModel import BaseModel, GeneralModel
 
 
 class BaseRunner(object):
@@ -22,10 +39,17 @@ class BaseRunner(object):
 							help='Number of epochs.')
 		parser.add_argument('--check_epoch', type=int, default=1,
 							help='Check some tensors every check_epoch.')
+		parser.add_argument('--eval_epoch', type=int, default=1,
+							help='Evaluate on dev every eval_epoch epochs (and at the last epoch).')
+		parser.add_argument('--dev_sample', type=float, default=0,
+							help='Ratio of a fixed dev subsample (stratified by user activity) for evaluation during training (0 means full dev).')
+		parser.add_argument('--async_eval', type=int, default=0,
+							help='Whether to evaluate a CPU snapshot of each epoch in a background thread while training goes on '
+								 '(the chosen epoch is the same as in sequence; its batches are loaded without worker processes).')
 		parser.add_argument('--test_epoch', type=int, default=-1,
 							help='Print test results every test_epoch (-1 means no print).')
 		parser.add_argument('--early_stop', type=int, default=10,
-							help='The number of epochs when dev results drop continuously.')
+							help='The number of epochs (not evaluations, see eval_epoch) when dev results drop continuously.')
 		parser.add_argument('--lr', type=float, default=1e-3,
 							help='Learning rate.')
 		parser.add_argument('--l2', type=float, default=0,
@@ -36,14 +60,43 @@ class BaseRunner(object):
 							help='Batch size during testing.')
 		parser.add_argument('--optimizer', type=str, default='Adam',
 							help='optimizer: SGD, Adam, Adagrad, Adadelta')
+		parser.add_argument('--sparse_emb', type=int, default=0,
+							help='Whether to use sparse gradients for the embedding tables a model supports.')
+		parser.add_argument('--sparse_optimizer', type=str, default='SparseAdam',
+							help='Optimizer for sparse embeddings: SparseAdam, Adagrad, RowWiseAdagrad')
+		parser.add_argument('--n_procs', type=int, default=1,
+							help='Number of data-parallel training processes on CPU (batch_size is split among them).')
+		parser.add_argument('--dist_timeout', type=int, default=7200,
+							help='Timeout (seconds) of collectives among data-parallel processes, e.g., waiting for the dev evaluation of rank 0.')
 		parser.add_argument('--num_workers', type=int, default=5,
 							help='Number of processors when prepare batches in DataLoader')
 		parser.add_argument('--pin_memory', type=int, default=0,
 							help='pin_memory in DataLoader')
+		parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+							help='Precision of model forward in training and prediction (losses are kept in fp32).')
+		parser.add_argument('--compile', type=int, default=0,
+							help='Whether to torch.compile model forward and loss (falls back to eager on failure).')
+		parser.add_argument('--hard_neg', type=int, default=0,
+							help='Draw hard negatives from item embedding neighbours, refreshed every hard_neg epochs (0 means off).')
+		parser.add_argument('--hard_neg_topn', type=int, default=100,
+							help='Size of the item neighbourhood for hard negatives.')
+		parser.add_argument('--hard_neg_ratio', type=float, default=0.5,
+							help='Ratio of hard negatives among the negatives of each instance.')
+		parser.add_argument('--prefetch_epoch', type=int, default=0,
+							help='Whether to sample the next epoch (e.g., negative items) in a background process during training')
+		parser.add_argument('--save_state', type=int, default=0,
+							help='Whether to save the full training state every epoch, to resume training with --load 1.')
+		parser.add_argument('--save_rows', type=int, default=0,
+							help='Whether to save per-row results (e.g., ground-truth ranks) of dev/test after training, for significance tests.')
+		parser.add_argument('--infer_procs', type=int, default=1,
+							help='Number of processes predicting row shards on CPU (each loads the weights memory-mapped).')
+		parser.add_argument('--pred_cache', type=str, default='',
+							help='Directory caching predictions under a hash of model weights, arguments and split contents (empty means off). '
+								 'Predictions are reused when nothing changed, e.g., with --train 0 --load 1.')
 		parser.add_argument('--topk', type=str, default='5,10,20,50',
 							help='The number of items recommended to each user.')
 		parser.add_argument('--metric', type=str, default='NDCG,HR',
-							help='metrics: NDCG, HR')
+							help='metrics: NDCG, HR, MRR, RECALL (CTR: ACC, AUC, GAUC, F1_SCORE, LOG_LOSS)')
 		parser.add_argument('--main_metric', type=str, default='',
 							help='Main metric to determine the best model.')
 		return parser
@@ -56,7 +109,6 @@ class BaseRunner(object):
 		:param metrics: metric string list
 		:return: a result dict, the keys are metric@topk
 		"""
-		evaluations = dict()
 		# sort_idx = (-predictions).argsort(axis=1)
 		# gt_rank = np.argwhere(sort_idx == 0)[:, 1] + 1
 		# ↓ As we only have one positive sample, comparing with the first item will be more efficient. 
@@ -65,31 +117,56 @@ class BaseRunner(object):
 		# 	predictions_rnd = predictions.copy()
 		# 	predictions_rnd[:,1:] += np.random.rand(predictions_rnd.shape[0], predictions_rnd.shape[1]-1)*1e-6
 		# 	gt_rank = (predictions_rnd > predictions[:,0].reshape(-1,1)).sum(axis=-1)+1
-		for k in topk:
-			hit = (gt_rank <= k)
-			for metric in metrics:
-				key = '{}@{}'.format(metric, k)
-				if metric == 'HR':
-					evaluations[key] = hit.mean()
-				elif metric == 'NDCG':
-					evaluations[key] = (hit / np.log2(gt_rank + 1)).mean()
-				else:
-					raise ValueError('Undefined evaluation metric: {}.'.format(metric))
-		return evaluations
+		return BaseRunner.rank_metrics(gt_rank, topk, metrics)
+
+	@staticmethod
+	def rank_metrics(gt_rank: np.ndarray, topk: list, metrics: list) -> Dict[str, float]:
+		"""
+		:param gt_rank: (-1,) shape, the rank of the ground-truth item among the candidates of each row (from 1)
+		:return: a result dict, the keys are metric@topk
+		"""
+		return {key: value.mean() for key, value in rank_metric_rows(gt_rank, topk, metrics).items()}
 
 	def __init__(self, args):
 		self.train_models = args.train
+		self.load = args.load
+		self.save_state = args.save_state
+		self.checkpointer = checkpoint.Checkpointer()  # writes checkpoints in background
+		self.best_state = None  # CPU snapshot of the best model
 		self.epoch = args.epoch
 		self.check_epoch = args.check_epoch
 		self.test_epoch = args.test_epoch
+		self.eval_epoch = args.eval_epoch
+		self.dev_sample = args.dev_sample
+		self.dev_tolerance = 0  # dev results within tolerance of the best one are not counted as improvements
+		self.dev_subsampled = False  # whether dev results during training come from a subsample
+		self.async_eval = args.async_eval
 		self.early_stop = args.early_stop
 		self.learning_rate = args.lr
 		self.batch_size = args.batch_size
 		self.eval_batch_size = args.eval_batch_size
 		self.l2 = args.l2
 		self.optimizer_name = args.optimizer
+		self.sparse_emb = args.sparse_emb
+		self.sparse_optimizer_name = args.sparse_optimizer
+		self.n_procs = args.n_procs
+		self.dist_timeout = args.dist_timeout
+		self.rank = 0  # rank of the data-parallel training process
+		self.distributed = False  # whether running inside a data-parallel training process
 		self.num_workers = args.num_workers
 		self.pin_memory = args.pin_memory
+		self.prefetch_epoch = args.prefetch_epoch
+		self.precision = args.precision
+		self.compile = args.compile
+		self.hard_neg = args.hard_neg
+		self.hard_neg_topn = args.hard_neg_topn
+		self.hard_neg_ratio = args.hard_neg_ratio
+		self.save_rows = args.save_rows
+		self.infer_procs = args.infer_procs
+		self.infer_worker = False  # whether running inside a sharded inference process
+		self.pred_cache = pred_cache.PredictionCache(args.pred_cache) if args.pred_cache else None
+		self.prefetchers = dict()  # background epoch preparation of each training dataset
+		self.seen_index = None  # CSR index (on device) of the clicked items of each user, masked in full ranking
 		self.topk = [int(x) for x in args.topk.split(',')]
 		self.metrics = [m.strip().upper() for m in args.metric.split(',')]
 		self.main_metric = '{}@{}'.format(self.metrics[0], self.topk[0]) if not len(args.main_metric) else args.main_metric # early stop based on main_metric
@@ -107,18 +184,361 @@ class BaseRunner(object):
 		self.time[1] = time()
 		return self.time[1] - tmp_time
 
+	def _actions_before_epoch(self, dataset: BaseModel.Dataset):
+		if not self.prefetch_epoch:
+			dataset.actions_before_epoch()
+			return
+		if id(dataset) not in self.prefetchers:
+			self.prefetchers[id(dataset)] = EpochPrefetcher(dataset)
+		self.prefetchers[id(dataset)].next_epoch()
+
+	def _close_prefetchers(self):
+		for prefetcher in self.prefetchers.values():
+			prefetcher.close()
+		self.prefetchers = dict()
+
+	def _model_loss(self, model: BaseModel, out_dict: dict, *args) -> torch.Tensor:
+		"""
+		Compute the loss of a model in fp32: under mixed precision, the floating-point outputs are upcast
+		before any (model-specific) loss reduces them.
+		"""
+		if self.precision != 'fp32':
+			out_dict = {k: v.float() if isinstance(v, torch.Tensor) and v.is_floating_point() else v
+						for k, v in out_dict.items()}
+		return model.loss(out_dict, *args).float()
+
+	def _autocast(self, device):
+		# bf16 keeps the fp32 exponent range, so no loss scaling is needed
+		if self.precision == 'bf16':
+			return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+		return contextlib.nullcontext()
+
+	def _mask_seen(self, dataset: BaseModel.Dataset, prediction: torch.Tensor, user_ids: torch.Tensor):
+		# set the scores of the train/residual clicked items to -inf in place (the candidates are all the items)
+		if self.seen_index is None:
+			corpus = dataset.corpus
+			seen_sets = {u: corpus.train_clicked_set[u] | corpus.residual_clicked_set[u] for u in corpus.train_clicked_set}
+			index = sampling.CSRIndex(seen_sets, corpus.n_users, corpus.n_items)
+			self.seen_index = (torch.from_numpy(index.indptr).to(prediction.device),
+							   torch.from_numpy(index.indices).to(prediction.device))
+		indptr, indices = self.seen_index
+		user_ids = user_ids.to(indptr.device)
+		starts, counts = indptr[user_ids], indptr[user_ids + 1] - indptr[user_ids]
+		rows = torch.repeat_interleave(torch.arange(len(user_ids), device=indptr.device), counts)
+		offsets = torch.arange(len(rows), device=indptr.device) - torch.repeat_interleave(counts.cumsum(0) - counts, counts)
+		prediction[rows.to(prediction.device), indices[starts[rows] + offsets].to(prediction.device)] = -np.inf
+
+	def _compile_model(self, model: BaseModel):
+		if not self.compile or getattr(model, 'compiled', False):
+			return
+		model.compiled = True
+		if not hasattr(torch, 'compile'):
+			logging.info('torch.compile is not available, run {} eagerly'.format(type(model).__name__))
+			return
+		import torch._dynamo.exc as dynamo_exc
+		# only failures of compilation fall back to eager, errors of the model code itself are raised
+		compile_errors = tuple(getattr(dynamo_exc, e) for e in ['BackendCompilerFailed', 'Unsupported']
+							   if hasattr(dynamo_exc, e))
+		for name in ['forward', 'loss']:
+			eager = getattr(model, name)
+			compiled = torch.compile(eager, dynamic=True)  # history and candidate lengths vary across batches
+
+			def run(*args, eager=eager, compiled=compiled, name=name, **kwargs):
+				try:
+					return compiled(*args, **kwargs)
+				except compile_errors as e:
+					logging.warning('Fail to compile {}.{}, fall back to eager: {}'.format(type(model).__name__, name, e))
+					setattr(model, name, eager)
+					return eager(*args, **kwargs)
+			setattr(model, name, run)
+
+	@staticmethod
+	def _item_embeddings(model: BaseModel):
+		if hasattr(model, 'encoder') and hasattr(model.encoder, 'embedding_dict'):  # LightGCN
+			return model.encoder.embedding_dict['item_emb']
+		if hasattr(model, 'i_embeddings'):
+			return model.i_embeddings.weight
+		return None
+
+	def _nearest_items(self, item_emb: torch.Tensor, top_n: int) -> np.ndarray:
+		# exact cosine top-N neighbours of every item, computed block by block
+		with torch.no_grad():
+			emb = F.normalize(item_emb.detach().float(), dim=-1)
+			top_n = min(top_n, len(emb) - 2)
+			neighbours = list()
+			for start in range(0, len(emb), self.eval_batch_size):
+				scores = emb[start:start + self.eval_batch_size] @ emb.T
+				rows = torch.arange(len(scores), device=scores.device)
+				scores[rows, start + rows] = -np.inf  # the item itself
+				scores[:, 0] = -np.inf  # padding item
+				neighbours.append(scores.topk(top_n, dim=-1).indices.cpu())
+		return torch.cat(neighbours).numpy()
+
+	def _refresh_hard_negatives(self, dataset: BaseModel.Dataset):
+		model = dataset.model
+		item_emb = self._item_embeddings(model)
+		if item_emb is None or not isinstance(dataset, GeneralModel.Dataset):
+			logging.info('Hard negatives are not supported by {}, keep the original sampler'.format(type(model).__name__))
+			self.hard_neg = 0
+			return
+		base = getattr(dataset, 'neg_sampler', None)
+		if isinstance(base, sampling.HardNegativeSampler):
+			base = base.base
+		elif base is None:
+			base = sampling.build_neg_sampler(model.neg_sampler, dataset.corpus, model.neg_alpha, model.neg_mix)
+		dataset.neg_sampler = sampling.HardNegativeSampler(base, base.index, self._nearest_items(item_emb, self.hard_neg_topn),
+														   dataset.data['item_id'], self.hard_neg_ratio)
+
 	def _build_optimizer(self, model):
 		logging.info('Optimizer: ' + self.optimizer_name)
-		optimizer = eval('torch.optim.{}'.format(self.optimizer_name))(
-			model.customize_parameters(), lr=self.learning_rate, weight_decay=self.l2)
-		return optimizer
+		sparse_params = model.enable_sparse_embeddings() if self.sparse_emb else list()
+		if not len(sparse_params):
+			optimizer = eval('torch.optim.{}'.format(self.optimizer_name))(
+				model.customize_parameters(), lr=self.learning_rate, weight_decay=self.l2)
+			return optimizer
+
+		# embeddings with sparse gradients get their own optimizer, dense layers stay on the chosen one
+		logging.info('Sparse optimizer for {}: {}'.format(model.sparse_embeddings, self.sparse_optimizer_name))
+		if self.l2 > 0:
+			logging.info('Weight decay is not applied to sparse embeddings')
+		sparse_ids = set(id(p) for p in sparse_params)
+		dense_groups = list()
+		for group in model.customize_parameters():
+			group = dict(group, params=[p for p in group['params'] if id(p) not in sparse_ids])
+			if len(group['params']):
+				dense_groups.append(group)
+		if self.sparse_optimizer_name == 'RowWiseAdagrad':
+			sparse_optimizer = optimizers.RowWiseAdagrad(sparse_params, lr=self.learning_rate)
+		else:
+			sparse_optimizer = eval('torch.optim.{}'.format(self.sparse_optimizer_name))(sparse_params, lr=self.learning_rate)
+		if not len(dense_groups):
+			return sparse_optimizer
+		dense_optimizer = eval('torch.optim.{}'.format(self.optimizer_name))(
+			dense_groups, lr=self.learning_rate, weight_decay=self.l2)
+		return optimizers.CombinedOptimizer([dense_optimizer, sparse_optimizer])
+
+	def _train_worker(self, rank: int, seed: int, init_file: str, data_dict: Dict[str, BaseModel.Dataset]):
+		# rank 0 evaluates on dev while the others wait for its stop flag, which may take long
+		dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=self.n_procs,
+								timeout=datetime.timedelta(seconds=self.dist_timeout))
+		self.rank, self.distributed = rank, True
+		torch.set_num_threads(max(1, torch.get_num_threads() // self.n_procs))
+		utils.init_seed(seed)  # own negative sampling in each process
+		distributed.shard_dataset(data_dict['train'], rank, self.n_procs)
+		try:
+			self.train(data_dict)
+		finally:
+			dist.destroy_process_group()
+
+	def _train_distributed(self, data_dict: Dict[str, BaseModel.Dataset]):
+		"""
+		Fork n_procs training processes that average their gradients with gloo, each on a shard of the training set.
+		Rank 0 evaluates on dev, saves the best model with save_model and decides early stop for all processes.
+		"""
+		model = data_dict['train'].model
+		ctx = mp.get_context('fork')
+		init_dir = tempfile.mkdtemp()
+		init_file = os.path.join(init_dir, 'dist_init')
+		seeds = np.random.randint(2 ** 31 - 1, size=self.n_procs).tolist()  # python ints, as random.seed requires
+		try:
+			processes = [ctx.Process(target=self._train_worker, args=(rank, seeds[rank], init_file, data_dict))
+						 for rank in range(self.n_procs)]
+			for process in processes:
+				process.start()
+			for process in processes:
+				try:
+					process.join()
+				except KeyboardInterrupt:  # workers stop by themselves
+					process.join()
+		finally:
+			shutil.rmtree(init_dir, ignore_errors=True)
+		if any(process.exitcode != 0 for process in processes):
+			raise RuntimeError('Data-parallel training failed, exit codes: {}'.format(
+				[process.exitcode for process in processes]))
+		model.load_model()
+
+	def _train_batch_size(self) -> int:
+		# the global batch is split among data-parallel processes
+		return max(1, self.batch_size // self.n_procs) if self.distributed else self.batch_size
+
+	def _optimizer_step(self, model: BaseModel):
+		if self.distributed:
+			distributed.all_reduce_gradients(model, self.n_procs)
+		model.optimizer.step()
+
+	def _epoch_loss(self, loss_lst: list) -> float:
+		if self.distributed:
+			return distributed.all_reduce_mean(np.mean(loss_lst).item(), self.n_procs)
+		return np.mean(loss_lst).item()
+
+	@staticmethod
+	def _state_path(model: BaseModel) -> str:
+		return os.path.splitext(model.model_path)[0] + '.state.pt'
+
+	def _dev_subsample(self, dataset: BaseModel.Dataset) -> BaseModel.Dataset:
+		"""
+		A fixed subsample of dev rows, stratified by the number of training interactions of the user (deciles),
+		so that every activity level keeps its share. The same rows are evaluated in every epoch.
+		"""
+		if not 0 < self.dev_sample < 1:
+			return dataset
+		users = dataset.data.get('user_id', np.zeros(len(dataset), dtype=int))
+		clicked_set = getattr(dataset.corpus, 'train_clicked_set', dict())
+		activity = np.array([len(clicked_set[u]) if u in clicked_set else 0 for u in users])
+		strata = np.searchsorted(np.quantile(activity, np.linspace(0, 1, 11)[1:-1]), activity, side='right')
+		rng = np.random.RandomState(0)  # independent of the training random stream
+		rows = list()
+		for stratum in np.unique(strata):
+			stratum_rows = np.nonzero(strata == stratum)[0]
+			n_sample = max(1, int(round(len(stratum_rows) * self.dev_sample)))
+			rows.append(rng.choice(stratum_rows, n_sample, replace=False))
+		rows = np.sort(np.concatenate(rows))
+		logging.info('Evaluate on {} of {} dev rows during training'.format(len(rows), len(dataset)))
+		return utils.select_rows(dataset, rows)
+
+	def _save_training_state(self, model: BaseModel, epoch: int, main_metric_results: list, dev_results: list,
+							 eval_epochs: list):
+		state = {'model': model.state_dict(), 'optimizer': model.optimizer.state_dict(), 'epoch': epoch,
+				 'main_metric_results': main_metric_results, 'dev_results': dev_results, 'eval_epochs': eval_epochs,
+				 'rng': checkpoint.get_rng_state()}
+		self.checkpointer.save(state, self._state_path(model))
+
+	def _resume_training_state(self, model: BaseModel):
+		"""
+		Restore the latest weights, optimizer, finished epochs, dev history and random states saved by _save_training_state.
+		:return: the number of finished epochs, main_metric_results, dev_results, eval_epochs
+		"""
+		state_path = self._state_path(model)
+		if not os.path.exists(state_path):
+			logging.info('No training state at {}, train from epoch 1'.format(state_path))
+			return 0, list(), list(), list()
+		# written by the runner itself, and the python/numpy random states are not tensors
+		state = torch.load(state_path, map_location=model.device, weights_only=False)
+		model.load_state_dict(state['model'])
+		if model.optimizer is None:
+			model.optimizer = self._build_optimizer(model)
+		model.optimizer.load_state_dict(state['optimizer'])
+		if not self.distributed:  # data-parallel processes are seeded by the main process
+			checkpoint.set_rng_state(state['rng'])
+		logging.info('Resume training state from {} (epoch {})'.format(state_path, state['epoch']))
+		eval_epochs = state.get('eval_epochs', list(range(1, len(state['main_metric_results']) + 1)))
+		return state['epoch'], state['main_metric_results'], state['dev_results'], eval_epochs
+
+	@staticmethod
+	def _eval_model_copy(model: BaseModel) -> BaseModel:
+		"""
+		A copy of the model (without optimizer and compiled wrappers) to evaluate weight snapshots in the background.
+		"""
+		optimizer, model.optimizer = getattr(model, 'optimizer', None), None
+		eval_model = copy.deepcopy(model)
+		model.optimizer = optimizer
+		for name in ['forward', 'loss']:
+			eval_model.__dict__.pop(name, None)
+		eval_model.compiled = False
+		eval_model.eval()
+		return eval_model
+
+	@staticmethod
+	def _eval_view(dataset: BaseModel.Dataset, eval_model: BaseModel, seed: int) -> BaseModel.Dataset:
+		"""
+		The same rows, predicted by another model in the background thread: its DataLoaders draw from a generator
+		of their own (not the global one used by training) and load in the thread (no worker forked from it).
+		"""
+		view = copy.copy(dataset)
+		view.model = eval_model
+		view.loader_args = {'num_workers': 0, 'generator': torch.Generator().manual_seed(seed)}
+		return view
+
+	def _eval_loader(self, dataset: BaseModel.Dataset) -> DataLoader:
+		loader_args = dict({'num_workers': self.num_workers}, **getattr(dataset, 'loader_args', dict()))
+		return DataLoader(dataset, batch_size=self.eval_batch_size, shuffle=False, collate_fn=dataset.collate_batch,
+						  pin_memory=self.pin_memory, **loader_args)
+
+	def _eval_epoch(self, dev_data: BaseModel.Dataset, test_data: BaseModel.Dataset = None, snapshot: dict = None):
+		"""
+		Evaluate the model of dev_data (after loading a weight snapshot, if given) on dev, and on test if given.
+		:return: dev result, test result (or None), evaluation time
+		"""
+		start = time()
+		if snapshot is not None:
+			dev_data.model.load_state_dict(snapshot)
+		dev_result = self.evaluate(dev_data, [self.main_topk], self.metrics)
+		test_result = self.evaluate(test_data, self.topk[:1], self.metrics) if test_data is not None else None
+		return dev_result, test_result, time() - start
+
+	def _record_eval(self, model: BaseModel, history: tuple, dev_data: BaseModel.Dataset, epoch: int, loss: float,
+					 training_time: float, evaluation: tuple, state: dict = None) -> bool:
+		"""
+		Record the dev (and test) results of an epoch, save the model if best, and check early stopping.
+		:param history: main metric results, dev results and evaluated epochs so far (appended in epoch order)
+		:param state: weights evaluated in the background (None means the current weights of the model)
+		:return: whether to stop training
+		"""
+		main_metric_results, dev_results, eval_epochs = history
+		dev_result, test_result, eval_time = evaluation
+		dev_results.append(dev_result)
+		main_metric_results.append(dev_result[self.main_metric])
+		eval_epochs.append(epoch)
+		if self.dev_subsampled:
+			self.dev_tolerance = self._dev_noise(main_metric_results[-1], len(dev_data))
+		logging_str = 'Epoch {:<5} loss={:<.4f} [{:<3.1f} s]	dev=({})'.format(
+			epoch, loss, training_time, utils.format_metric(dev_result))
+		if test_result is not None:
+			logging_str += ' test=({})'.format(utils.format_metric(test_result))
+		logging_str += ' [{:<.1f} s]'.format(eval_time)
+
+		# Save model and early stop
+		if max(main_metric_results) == main_metric_results[-1] or \
+				(hasattr(model, 'stage') and model.stage == 1):
+			self.best_state = self.checkpointer.save(model.state_dict() if state is None else state, model.model_path)
+			logging_str += ' *'
+		logging.info(logging_str)
+		if self.early_stop > 0 and self.eval_termination(main_metric_results, eval_epochs):
+			logging.info("Early stop at %d based on dev result (no improvement for %d epochs)." % (epoch, self.early_stop))
+			return True
+		return False
+
+	def _consume_evals(self, pending: list, model: BaseModel, history: tuple, dev_data: BaseModel.Dataset,
+					   wait: int = 0) -> bool:
+		"""
+		Record background evaluations strictly in epoch order: finished ones, and at least the `wait` oldest ones.
+		Results after an early stop are dropped, so the chosen epoch is the same as with sequential evaluation.
+		:return: whether to stop training
+		"""
+		while len(pending) and (pending[0][-1].done() or wait > 0):
+			epoch, loss, training_time, snapshot, future = pending.pop(0)
+			wait -= 1
+			if self._record_eval(model, history, dev_data, epoch, loss, training_time, future.result(), snapshot):
+				return True
+		return False
 
 	def train(self, data_dict: Dict[str, BaseModel.Dataset]):
 		model = data_dict['train'].model
-		main_metric_results, dev_results = list(), list()
+		if self.n_procs > 1 and not self.distributed:
+			if model.device.type != 'cpu':
+				logging.info('Data-parallel training is only for CPU, train in a single process')
+			else:
+				return self._train_distributed(data_dict)
+		if self.hard_neg > 0 and getattr(model, 'neg_sampler', None) == 'inbatch':
+			raise ValueError('--hard_neg does not work with --neg_sampler inbatch, whose negatives are drawn in each batch.')
+		main_metric_results, dev_results, eval_epochs, start_epoch = list(), list(), list(), 0
+		if self.load > 0 and self.save_state:
+			start_epoch, main_metric_results, dev_results, eval_epochs = self._resume_training_state(model)
+		history = (main_metric_results, dev_results, eval_epochs)
+		dev_data = self._dev_subsample(data_dict['dev']) if self.rank == 0 else None
+		self.dev_subsampled = self.rank == 0 and dev_data is not data_dict['dev']
+		# background evaluation of weight snapshots, overlapped with the next epochs
+		pipelined = self.async_eval and self.rank == 0
+		if pipelined and self.save_state:
+			logging.info('Evaluate in sequence with training, as the saved training state must include all dev results')
+			pipelined = False
+		executor, eval_model, pending = None, None, list()
+		if pipelined:
+			executor = ThreadPoolExecutor(max_workers=1)
 		self._check_time(start=True)
 		try:
-			for epoch in range(self.epoch):
+			stop = False
+			for epoch in range(start_epoch, self.epoch):
 				# Fit
 				self._check_time()
 				gc.collect()
@@ -128,134 +548,335 @@ class BaseRunner(object):
 					logging.info("Loss is Nan. Stop training at %d."%(epoch+1))
 					break
 				training_time = self._check_time()
+				if self.rank > 0:  # evaluation and checkpointing only happen on rank 0
+					if distributed.broadcast_flag(False):
+						break
+					continue
 
 				# Observe selected tensors
 				if len(model.check_list) > 0 and self.check_epoch > 0 and epoch % self.check_epoch == 0:
 					utils.check(model.check_list)
 
-				# Record dev results
-				dev_result = self.evaluate(data_dict['dev'], [self.main_topk], self.metrics)
-				dev_results.append(dev_result)
-				main_metric_results.append(dev_result[self.main_metric])
-				logging_str = 'Epoch {:<5} loss={:<.4f} [{:<3.1f} s]	dev=({})'.format(
-					epoch + 1, loss, training_time, utils.format_metric(dev_result))
-
-				# Test
-				if self.test_epoch > 0 and epoch % self.test_epoch  == 0:
-					test_result = self.evaluate(data_dict['test'], self.topk[:1], self.metrics)
-					logging_str += ' test=({})'.format(utils.format_metric(test_result))
-				testing_time = self._check_time()
-				logging_str += ' [{:<.1f} s]'.format(testing_time)
-
-				# Save model and early stop
-				if max(main_metric_results) == main_metric_results[-1] or \
-						(hasattr(model, 'stage') and model.stage == 1):
-					model.save_model()
-					logging_str += ' *'
-				logging.info(logging_str)
-
-				if self.early_stop > 0 and self.eval_termination(main_metric_results):
-					logging.info("Early stop at %d based on dev result." % (epoch + 1))
+				with_test = self.test_epoch > 0 and epoch % self.test_epoch == 0
+				if (epoch + 1) % self.eval_epoch != 0 and epoch + 1 < self.epoch:
+					logging.info('Epoch {:<5} loss={:<.4f} [{:<3.1f} s]'.format(epoch + 1, loss, training_time))
+					if self.save_state:
+						self._save_training_state(model, epoch + 1, main_metric_results, dev_results, eval_epochs)
+				elif pipelined:
+					# evaluate a CPU snapshot of this epoch in the background, at most one more waits behind it
+					if eval_model is None:
+						eval_model = self._eval_model_copy(model)
+					snapshot = checkpoint.to_cpu(model.state_dict())
+					# generators seeded here in the main thread, from the run seed and the epoch
+					seed = torch.initial_seed() + epoch + 1
+					test_view = self._eval_view(data_dict['test'], eval_model, seed) if with_test else None
+					future = executor.submit(self._eval_epoch, self._eval_view(dev_data, eval_model, seed), test_view, snapshot)
+					pending.append((epoch + 1, loss, training_time, snapshot, future))
+				else:
+					# Record dev results
+					test_data = data_dict['test'] if with_test else None
+					stop = self._record_eval(model, history, dev_data, epoch + 1, loss, training_time,
+											 self._eval_epoch(dev_data, test_data))
+					self._check_time()
+					if self.save_state:
+						self._save_training_state(model, epoch + 1, main_metric_results, dev_results, eval_epochs)
+				if pipelined:
+					stop = self._consume_evals(pending, model, history, dev_data, wait=len(pending) - 2)
+
+				if self.distributed:
+					stop = distributed.broadcast_flag(stop)
+				if stop:
 					break
+			if pipelined and not stop:  # the last epochs are still being evaluated
+				self._consume_evals(pending, model, history, dev_data, wait=len(pending))
 
 		except KeyboardInterrupt:
 			logging.info("Early stop manually")
+			if self.distributed:  # the main process goes on with evaluation
+				if executor is not None:
+					executor.shutdown(wait=True, cancel_futures=True)
+				self._close_prefetchers()
+				self.checkpointer.wait()
+				return
 			exit_here = input("Exit completely without evaluation? (y/n) (default n):")
 			if exit_here.lower().startswith('y'):
 				logging.info(os.linesep + '-' * 45 + ' END: ' + utils.get_time() + ' ' + '-' * 45)
 				exit(1)
+		if executor is not None:  # evaluations after an early stop are not needed
+			executor.shutdown(wait=True, cancel_futures=True)
+		self._close_prefetchers()
+		self.checkpointer.wait()
+		if self.rank > 0:
+			return
 
 		# Find the best dev result across iterations
-		best_epoch = main_metric_results.index(max(main_metric_results))
+		best_idx = main_metric_results.index(max(main_metric_results))
 		logging.info(os.linesep + "Best Iter(dev)={:>5}\t dev=({}) [{:<.1f} s] ".format(
-			best_epoch + 1, utils.format_metric(dev_results[best_epoch]), self.time[1] - self.time[0]))
-		model.load_model()
+			eval_epochs[best_idx], utils.format_metric(dev_results[best_idx]), self.time[1] - self.time[0]))
+		if self.best_state is not None:
+			model.load_state_dict(self.best_state)
+			logging.info('Load model from the best snapshot')
+		else:
+			model.load_model()
+		if dev_data is not data_dict['dev']:  # confirm the chosen epoch on the full dev set
+			dev_result = self.evaluate(data_dict['dev'], [self.main_topk], self.metrics)
+			logging.info('Best Iter(dev)={:>5}\t full dev=({})'.format(eval_epochs[best_idx], utils.format_metric(dev_result)))
 
 	def fit(self, dataset: BaseModel.Dataset, epoch=-1) -> float:
 		model = dataset.model
 		if model.optimizer is None:
 			model.optimizer = self._build_optimizer(model)
-		dataset.actions_before_epoch()  # must sample before multi thread start
+		self._compile_model(model)
+		if self.hard_neg > 0 and epoch > 1 and (epoch - 1) % self.hard_neg == 0:  # embeddings are random before training
+			self._refresh_hard_negatives(dataset)
+			# the epoch being prefetched was sampled with the old sampler: sample it again with the new one
+			if id(dataset) in self.prefetchers:
+				self.prefetchers.pop(id(dataset)).close()
+		self._actions_before_epoch(dataset)  # must sample before multi thread start
 
 		model.train()
 		loss_lst = list()
-		dl = DataLoader(dataset, batch_size=self.batch_size, shuffle=True, num_workers=self.num_workers,
+		dl = DataLoader(dataset, batch_size=self._train_batch_size(), shuffle=True, num_workers=self.num_workers,
 						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
 		for batch in tqdm(dl, leave=False, desc='Epoch {:<3}'.format(epoch), ncols=100, mininterval=1):
 			batch = utils.batch_to_gpu(batch, model.device)
 
-			# randomly shuffle the items to avoid models remembering the first item being the target
-			item_ids = batch['item_id']
-			# for each row (sample), get random indices and shuffle the original items
-			indices = torch.argsort(torch.rand(*item_ids.shape), dim=-1)						
-			batch['item_id'] = item_ids[torch.arange(item_ids.shape[0]).unsqueeze(-1), indices]
+			if model.shuffle_candidates:
+				# randomly permute the items of each row on device to avoid models remembering the first item being the target
+				indices = torch.rand(batch['item_id'].shape, device=batch['item_id'].device).argsort(dim=-1)
+				batch['item_id'] = batch['item_id'].gather(-1, indices)
 
 			model.optimizer.zero_grad()
-			out_dict = model(batch)
+			with self._autocast(model.device):
+				out_dict = model(batch)
 
-			# shuffle the predictions back so that the prediction scores match the original order (first item is the target)
 			prediction = out_dict['prediction']
-			if len(prediction.shape)==2: # only for ranking tasks
-				restored_prediction = torch.zeros(*prediction.shape).to(prediction.device)
-				# use the random indices to shuffle back
-				restored_prediction[torch.arange(item_ids.shape[0]).unsqueeze(-1), indices] = prediction   
-				out_dict['prediction'] = restored_prediction
+			if model.shuffle_candidates and len(prediction.shape) == 2:  # only for ranking tasks
+				# scatter the predictions back so that the scores match the original order (first item is the target)
+				out_dict['prediction'] = torch.empty_like(prediction).scatter(-1, indices, prediction)
 
-			loss = model.loss(out_dict)
+			loss = self._model_loss(model, out_dict)
 			loss.backward()
-			model.optimizer.step()
+			self._optimizer_step(model)
 			loss_lst.append(loss.detach().cpu().data.numpy())
-		return np.mean(loss_lst).item()
+		return self._epoch_loss(loss_lst)
 
-	def eval_termination(self, criterion: List[float]) -> bool:
-		if len(criterion) > self.early_stop and utils.non_increasing(criterion[-self.early_stop:]):
+	@staticmethod
+	def _dev_noise(value: float, n: int) -> float:
+		# standard error of a mean of n per-row metrics in [0, 1] (at most sqrt(m(1-m)/n) for mean m)
+		value = min(max(value, 0), 1)
+		return np.sqrt(value * (1 - value) / n)
+
+	def eval_termination(self, criterion: List[float], epochs: List[int] = None) -> bool:
+		"""
+		:param epochs: the epoch of each dev result (every epoch by default), patience (early_stop) is counted in epochs
+		"""
+		epochs = list(range(1, len(criterion) + 1)) if epochs is None else epochs
+		recent = [x for x, e in zip(criterion, epochs) if e > epochs[-1] - self.early_stop]
+		if len(criterion) > len(recent) and utils.non_increasing(recent):
 			return True
-		elif len(criterion) - criterion.index(max(criterion)) > self.early_stop:
+		# on a dev subsample, only gains beyond its noise count as improvements
+		best = next(i for i, x in enumerate(criterion) if x >= max(criterion) - self.dev_tolerance)
+		if epochs[-1] - epochs[best] >= self.early_stop:
 			return True
 		return False
 
-	def evaluate(self, dataset: BaseModel.Dataset, topks: list, metrics: list) -> Dict[str, float]:
+	def evaluate(self, dataset: BaseModel.Dataset, topks: list, metrics: list, predictions=None) -> Dict[str, float]:
 		"""
 		Evaluate the results for an input dataset.
+		:param predictions: output of predict/predict_topk on the dataset, if already computed
 		:return: result dict (key: metric@k)
 		"""
-		predictions = self.predict(dataset)
+		if predictions is None and self.pred_cache is not None:
+			predictions = self.pred_cache.get(self._prediction_key(dataset))
+		if predictions is None:  # accumulate the metrics batch by batch on device, no score is kept
+			accumulator = RankAccumulator(topks, metrics)
+			for batch, prediction in self._iter_predictions(dataset):
+				accumulator.update((prediction >= prediction[:, :1]).sum(dim=-1))
+			return accumulator.result()
+		if isinstance(predictions, dict):
+			return self.rank_metrics(predictions['gt_rank'], topks, metrics)
 		return self.evaluate_method(predictions, topks, metrics)
 
+	def _item_vectors(self, model: BaseModel):
+		"""
+		Item representations computed once per prediction, if the model scores the whole catalog by dot products.
+		"""
+		if not isinstance(model, GeneralModel) or not model.catalog_scoring():
+			return None
+		with torch.no_grad(), self._autocast(model.device):
+			return model.item_representations()
+
+	def _predict_batch(self, model: BaseModel, batch: dict, item_vectors=None) -> torch.Tensor:
+		with torch.no_grad(), self._autocast(model.device):
+			if item_vectors is not None:
+				# one [batch_size, n_items] matrix product, laid out as full ranking: ground truth first, then items 1..n_items-1
+				user_vectors = model.user_representation(batch)
+				prediction = user_vectors @ item_vectors.T
+				prediction[:, 0] = (user_vectors * item_vectors[batch['item_id'][:, 0]]).sum(-1)
+			elif hasattr(model, 'inference'):
+				prediction = model.inference(batch)['prediction']
+			else:
+				prediction = model(batch)['prediction']
+		return prediction.float()
+
+	def _iter_predictions(self, dataset: BaseModel.Dataset):
+		"""
+		Predict the dataset batch by batch, yielding each batch (on device) and its [batch_size, n_candidates] scores.
+		In full ranking (test_all), the clicked items of each user are masked with -inf.
+		"""
+		model = dataset.model
+		model.eval()
+		self._compile_model(model)
+		item_vectors = self._item_vectors(model)
+		dl = self._eval_loader(dataset)
+		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
+			batch = utils.batch_to_gpu(batch, model.device)
+			prediction = self._predict_batch(model, batch, item_vectors)
+			if model.test_all:
+				self._mask_seen(dataset, prediction, batch['user_id'])
+			yield batch, prediction
+
+	def _prediction_key(self, dataset: BaseModel.Dataset) -> str:
+		corpus = getattr(dataset, 'corpus', None)
+		return pred_cache.fingerprint(dataset.model, dataset, type(self).__name__, self.precision,
+									  getattr(corpus, 'prefix', ''), getattr(corpus, 'dataset', ''))
+
+	def _cached_predict(self, dataset: BaseModel.Dataset, kind: str, predict_fn):
+		"""
+		Run predict_fn, or load its result from the prediction cache if the model and split are unchanged.
+		"""
+		if self.pred_cache is None:
+			return predict_fn()
+		key = self._prediction_key(dataset)
+		predictions = self.pred_cache.get(key, kind)
+		if predictions is not None:
+			logging.info('Load {} predictions of {} from cache {}'.format(kind, dataset.phase, key))
+			return predictions
+		predictions = predict_fn()
+		self.pred_cache.put(key, kind, predictions)
+		return predictions
+
+	def _infer_worker(self, rank: int, weight_file: str, result_dir: str, dataset: BaseModel.Dataset,
+					  method: str, args: tuple):
+		self.infer_worker = True
+		torch.set_num_threads(max(1, torch.get_num_threads() // self.infer_procs))
+		model = dataset.model
+		model.load_state_dict(torch.load(weight_file, map_location='cpu', mmap=True), assign=True)
+		rows = np.array_split(np.arange(len(dataset)), self.infer_procs)[rank]
+		predictions = getattr(self, method)(utils.select_rows(dataset, rows), *args)
+		pred_type, arrays = pred_cache.pack_predictions(predictions)
+		utils.save_npz(os.path.join(result_dir, 'shard{}.npz'.format(rank)), dict(arrays, pred_type=np.array(pred_type)))
+
+	def _sharded_predict(self, dataset: BaseModel.Dataset, method: str, *args):
+		"""
+		Run a prediction method on consecutive row shards in infer_procs forked processes (CPU only).
+		The weights are saved once and memory-mapped by every process, each shard is written to its own
+		npz file, and the shards are merged in row order.
+		"""
+		model = dataset.model
+		if self.infer_procs <= 1 or self.infer_worker or self.distributed or model.device.type != 'cpu' \
+				or len(dataset) < self.infer_procs:
+			return getattr(self, method)(dataset, *args)
+		result_dir = tempfile.mkdtemp()
+		try:
+			weight_file = os.path.join(result_dir, 'weights.pt')
+			torch.save(model.state_dict(), weight_file)
+			ctx = mp.get_context('fork')
+			processes = [ctx.Process(target=self._infer_worker, args=(rank, weight_file, result_dir, dataset, method, args))
+						 for rank in range(self.infer_procs)]
+			for process in processes:
+				process.start()
+			for process in processes:
+				process.join()
+			if any(process.exitcode != 0 for process in processes):
+				raise RuntimeError('Sharded inference failed, exit codes: {}'.format(
+					[process.exitcode for process in processes]))
+			parts = [utils.load_npz(os.path.join(result_dir, 'shard{}.npz'.format(rank)))
+					 for rank in range(self.infer_procs)]
+			pred_type = str(parts[0]['pred_type'])
+			parts = [{k: v for k, v in part.items() if k != 'pred_type'} for part in parts]
+			return pred_cache.unpack_predictions(pred_type, distributed.merge_shards(parts))
+		finally:
+			shutil.rmtree(result_dir, ignore_errors=True)
+
 	def predict(self, dataset: BaseModel.Dataset, save_prediction: bool = False) -> np.ndarray:
 		"""
 		The returned prediction is a 2D-array, each row corresponds to all the candidates,
 		and the ground-truth item poses the first.
 		Example: ground-truth items: [1, 2], 2 negative items for each instance: [[3,4], [5,6]]
 				 predictions like: [[1,3,4], [2,5,6]]
+		Scores are written into one preallocated array (rows with fewer candidates are padded with -inf).
 		"""
-		dataset.model.eval()
-		predictions = list()
-		dl = DataLoader(dataset, batch_size=self.eval_batch_size, shuffle=False, num_workers=self.num_workers,
-						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
-			if hasattr(dataset.model,'inference'):
-				prediction = dataset.model.inference(utils.batch_to_gpu(batch, dataset.model.device))['prediction']
-			else:
-				prediction = dataset.model(utils.batch_to_gpu(batch, dataset.model.device))['prediction']
-			predictions.extend(prediction.cpu().data.numpy())
-		predictions = np.array(predictions)
-
-		if dataset.model.test_all:
-			rows, cols = list(), list()
-			for i, u in enumerate(dataset.data['user_id']):
-				clicked_items = list(dataset.corpus.train_clicked_set[u] | dataset.corpus.residual_clicked_set[u])
-				idx = list(np.ones_like(clicked_items) * i)
-				rows.extend(idx)
-				cols.extend(clicked_items)
-			predictions[rows, cols] = -np.inf
-		return predictions
+		return self._cached_predict(dataset, 'scores', lambda: self._sharded_predict(dataset, '_predict_scores'))
+
+	def _predict_scores(self, dataset: BaseModel.Dataset) -> np.ndarray:
+		predictions, start = None, 0
+		for batch, prediction in self._iter_predictions(dataset):
+			prediction = prediction.cpu().numpy()
+			if predictions is None:
+				predictions = np.full((len(dataset), prediction.shape[1]), -np.inf, dtype=np.float32)
+			elif prediction.shape[1] > predictions.shape[1]:
+				predictions = np.pad(predictions, ((0, 0), (0, prediction.shape[1] - predictions.shape[1])),
+									 constant_values=-np.inf)
+			predictions[start:start + len(prediction), :prediction.shape[1]] = prediction
+			start += len(prediction)
+		return predictions if predictions is not None else np.zeros((0, 0), dtype=np.float32)
+
+	def predict_topk(self, dataset: BaseModel.Dataset, topk: int = 0) -> Dict[str, np.ndarray]:
+		"""
+		Prediction streamed batch by batch: in full ranking (test_all) clicked items are masked on device, and only
+		the rank of the ground-truth item and the top-k candidates of each row (partial sort on device) are kept.
+		:return: dict of gt_rank (-1,), and if topk > 0, item_id and score (-1, topk) sorted by score
+		"""
+		return self._cached_predict(dataset, 'top{}'.format(topk), lambda: self._sharded_predict(dataset, '_predict_topk', topk))
+
+	def _predict_topk(self, dataset: BaseModel.Dataset, topk: int) -> Dict[str, np.ndarray]:
+		gt_ranks, top_items, top_scores = list(), list(), list()
+		for batch, prediction in self._iter_predictions(dataset):
+			gt_ranks.append((prediction >= prediction[:, :1]).sum(dim=-1).cpu())
+			if topk > 0:
+				scores, cols = prediction.topk(min(topk, prediction.shape[1]), dim=-1)
+				if dataset.model.test_all:  # column j > 0 holds item j in full ranking, column 0 the ground-truth item
+					items = torch.where(cols == 0, batch['item_id'][:, :1], cols)
+				else:
+					items = batch['item_id'].gather(1, cols)
+				top_items.append(items.cpu())
+				top_scores.append(scores.cpu())
+		result = {'gt_rank': torch.cat(gt_ranks).numpy()}
+		if topk > 0:
+			result['item_id'] = torch.cat(top_items).numpy().astype(np.int32)
+			result['score'] = torch.cat(top_scores).numpy()
+		return result
+
+	def row_results(self, dataset: BaseModel.Dataset, predictions=None) -> Dict[str, np.ndarray]:
+		"""
+		Per-row results of a dataset, from which every metric can be recomputed row by row (see utils.significance).
+		:return: dict of user_id and gt_rank (-1,) arrays
+		"""
+		if predictions is None:
+			predictions = self.predict_topk(dataset)
+		if isinstance(predictions, dict):
+			gt_rank = predictions['gt_rank']
+		else:
+			gt_rank = (predictions >= predictions[:, :1]).sum(axis=-1)
+		return {'user_id': np.asarray(dataset.data['user_id'], dtype=np.int32), 'gt_rank': gt_rank.astype(np.int32)}
+
+	def save_row_results(self, dataset: BaseModel.Dataset, predictions=None) -> str:
+		"""
+		Save the per-row results of a dataset next to its prediction results (one file per split and seed).
+		"""
+		path = os.path.join(self.log_path, self.save_appendix, 'rows-{}.npz'.format(dataset.phase))
+		significance.save_rows(path, self.row_results(dataset, predictions))
+		logging.info('Saving per-row results to: {}'.format(path))
+		return path
 
-	def print_res(self, dataset: BaseModel.Dataset) -> str:
+	def print_res(self, dataset: BaseModel.Dataset, predictions=None) -> str:
 		"""
 		Construct the final result string before/after training
+		:param predictions: output of predict on the dataset, if already computed (e.g., also used for export)
 		:return: test result string
 		"""
-		result_dict = self.evaluate(dataset, self.topk, self.metrics)
+		result_dict = self.evaluate(dataset, self.topk, self.metrics, predictions=predictions)
 		res_str = '(' + utils.format_metric(result_dict) + ')'
 		return res_str
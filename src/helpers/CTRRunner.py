@@ -8,10 +8,10 @@ import logging
 import numpy as np
 from time import time
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 from typing import Dict, List
 
 from utils import utils
+from utils.metrics import CTRAccumulator, group_auc
 from models.BaseModel import BaseModel
 from helpers.BaseRunner import BaseRunner
 
@@ -20,11 +20,12 @@ import sklearn.metrics as sk_metrics
 class CTRRunner(BaseRunner):
 
 	@staticmethod
-	def evaluate_method(predictions: np.ndarray,labels: np.ndarray, metrics: list) -> Dict[str, float]:
+	def evaluate_method(predictions: np.ndarray,labels: np.ndarray, metrics: list, users: np.ndarray = None) -> Dict[str, float]:
 		"""
 		:param predictions: An array of predictions for all samples 
 		:param labels: An array of labels for all samples (0 or 1)
 		:param metrics: metric string list
+		:param users: An array of user ids for all samples (required by GAUC)
 		:return: a result dict, the keys are metrics
 		"""
 		evaluations = dict()
@@ -33,6 +34,8 @@ class CTRRunner(BaseRunner):
 				evaluations[metric] = ((predictions>0.5).astype(int)==labels.astype(int)).mean()
 			elif metric == 'AUC':
 				evaluations[metric] = sk_metrics.roc_auc_score(labels,predictions)
+			elif metric == 'GAUC':
+				evaluations[metric] = group_auc(np.asarray(users), predictions, labels)
 			elif metric == 'F1_SCORE':
 				evaluations[metric] = sk_metrics.f1_score(labels,(predictions>0.5).astype(int))
 			elif metric == 'LOG_LOSS':
@@ -46,34 +49,60 @@ class CTRRunner(BaseRunner):
 		super().__init__(args)
 		self.main_metric = self.metrics[0] if not len(args.main_metric) else self.main_metric
 	
-	def evaluate(self, dataset: BaseModel.Dataset, topks: list, metrics: list) -> Dict[str, float]:
+	def evaluate(self, dataset: BaseModel.Dataset, topks: list, metrics: list, predictions=None) -> Dict[str, float]:
 		"""
 		Evaluate the results for an input dataset.
+		:param predictions: (predictions, labels) returned by predict, if already computed
 		:return: result dict (key: metric)
 		"""
-		predictions, labels = self.predict(dataset)
-		return self.evaluate_method(predictions, labels, metrics)
+		if predictions is None and self.pred_cache is not None:
+			predictions = self.pred_cache.get(self._prediction_key(dataset))
+		if predictions is None:  # streaming metrics, the predictions are not kept (AUC from score histograms)
+			accumulator = CTRAccumulator(metrics)
+			for batch, prediction, label in self._iter_ctr_predictions(dataset):
+				accumulator.update(prediction, label, batch['user_id'])
+			return accumulator.result()
+		predictions, labels = predictions
+		return self.evaluate_method(predictions, labels, metrics, dataset.data['user_id'])
+
+	def _iter_ctr_predictions(self, dataset: BaseModel.Dataset):
+		"""
+		Predict the dataset batch by batch, yielding each batch (on device), its predictions and labels.
+		"""
+		dataset.model.eval()
+		self._compile_model(dataset.model)
+		dataset.model.phase = 'eval'
+		dl = self._eval_loader(dataset)
+		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
+			batch = utils.batch_to_gpu(batch, dataset.model.device)
+			with torch.no_grad(), self._autocast(dataset.model.device):
+				if hasattr(dataset.model,'inference'):
+					out_dict = dataset.model.inference(batch)
+				else:
+					out_dict = dataset.model(batch)
+			yield batch, out_dict['prediction'].float(), out_dict['label']
 
 	def predict(self, dataset: BaseModel.Dataset, save_prediction: bool = False) -> np.ndarray:
 		"""
 		The returned prediction is a 1D-array corresponding to all samples,
 		and ground truth labels are binary.
 		"""
-		dataset.model.eval()
-		dataset.model.phase = 'eval'
+		return self._cached_predict(dataset, 'scores', lambda: self._sharded_predict(dataset, '_predict_scores'))
+
+	def _predict_scores(self, dataset: BaseModel.Dataset):
 		predictions, labels = list(), list()
-		dl = DataLoader(dataset, batch_size=self.eval_batch_size, shuffle=False, num_workers=self.num_workers,
-						collate_fn=dataset.collate_batch, pin_memory=self.pin_memory)
-		for batch in tqdm(dl, leave=False, ncols=100, mininterval=1, desc='Predict'):
-			if hasattr(dataset.model,'inference'):
-				out_dict = dataset.model.inference(utils.batch_to_gpu(batch, dataset.model.device))
-				prediction, label = out_dict['prediction'], out_dict['label']
-			else:
-				out_dict = dataset.model(utils.batch_to_gpu(batch, dataset.model.device))
-				prediction, label = out_dict['prediction'], out_dict['label']
-			predictions.extend(prediction.cpu().data.numpy())
-			labels.extend(label.cpu().data.numpy())
-		predictions = np.array(predictions)
-		labels = np.array(labels)
+		for batch, prediction, label in self._iter_ctr_predictions(dataset):
+			predictions.append(prediction.cpu().data.numpy().reshape(len(label), *prediction.shape[1:]))
+			labels.append(label.cpu().data.numpy())
+		predictions = np.concatenate(predictions) if len(predictions) else np.array([])
+		labels = np.concatenate(labels) if len(labels) else np.array([])
 
 		return predictions, labels
+
+	def row_results(self, dataset: BaseModel.Dataset, predictions=None) -> Dict[str, np.ndarray]:
+		"""
+		Per-row predictions and labels, from which ACC and LOG_LOSS can be recomputed row by row.
+		"""
+		predictions, labels = self.predict(dataset) if predictions is None else predictions
+		return {'user_id': np.asarray(dataset.data['user_id'], dtype=np.int32),
+				'prediction': np.asarray(predictions, dtype=np.float32).reshape(-1), 'label': np.asarray(labels, dtype=np.int8)}
@@ -12,64 +12,19 @@ from torch.utils.data import DataLoader
 from typing import Dict, List
 
 from utils import utils
+from utils import sampling
 from models.BaseModel import BaseModel
 from helpers.BaseRunner import BaseRunner
 
-def HR_at_k(labels, valid_num, k):
-	indices = np.arange(labels.shape[1]) < valid_num[:, None]
-	labels = labels * indices
-	num_hits = np.sum(labels[:,:k], axis=1)
-
-	# Hit rate at k: one positive before k then hitrate of this list is 1
-	positive_num = np.sum(labels, axis=1)
-	positive_num[positive_num == 0] = 1
-	positive_num[positive_num > k] = k # when have more than k positives, attention
-	
-	hit_rate = num_hits / positive_num
-	hit_rate[hit_rate > 0] = 1
-	return hit_rate
-
-def DCG_at_k(labels, valid_num, k):
-	indices = np.arange(labels.shape[1]) < valid_num[:, None]
-	labels = labels * indices
-	labels = labels[:,:k]
-	dcg = np.sum(labels / np.log2(np.arange(2, labels.shape[1] + 2)), axis=1)    
-	return dcg
-
-def NDCG_at_k(labels, valid_num, k):
-	indices = np.arange(labels.shape[1]) < valid_num[:, None]
-	labels = labels * indices
-	dcg = DCG_at_k(labels, valid_num, k)  # DCG @ k of each row
-	
-	# ideal DCG
-	sorted_labels = np.sort(labels, axis=1)[:, ::-1]
-	ideal_dcg = DCG_at_k(sorted_labels, valid_num, k)
-	
-	ideal_dcg[ideal_dcg == 0] = 1
-	ndcg = dcg / ideal_dcg
-	
-	return ndcg
-
-def AP_at_k(labels, valid_num, k):
-	indices = np.arange(labels.shape[1]) < valid_num[:, None]
-	labels = labels * indices
-	
-	# Precision for each row
-	num_positive_predictions = np.cumsum(labels, axis=1)
-	num_positive_predictions[:, k:] = 0
-	precision = num_positive_predictions / np.arange(1, labels.shape[1] + 1)
-	
-	positive_num = np.sum(labels, axis=1)
-	positive_num[positive_num == 0] = 1
-	positive_num[positive_num > k] = k # when have more than k positives, attention
-	average_precision = np.sum(precision * labels, axis=1) / positive_num
-	return average_precision
-
 class ImpressionRunner(BaseRunner):
 	@staticmethod
 	def parse_runner_args(parser):
 		return BaseRunner.parse_runner_args(parser)
 
+	def __init__(self, args):
+		super().__init__(args)
+		self.his_index = None  # CSR index of the historical items of each user, masked in full ranking
+
 	@staticmethod
 	def evaluate_method(predictions: np.ndarray, topk: list, metrics: list, test_all: bool, neg_num, pos_num_max, pos_num = None, check_sort_idx = 0, test_num_neg = 0,ret_all = 0) -> Dict[str, float]:
 		"""
@@ -87,111 +42,119 @@ class ImpressionRunner(BaseRunner):
 			#predictions: pos, -inf, neg, -inf
 
 			#make sure that positive items will be ranked lower than neg items, when they have the same prediction values
-			pos_mask = np.ones((predictions.shape[0],pos_num_max))
-			rest_mask = np.zeros((predictions.shape[0],predictions.shape[1]-pos_num_max))
-			a_mask = np.concatenate((pos_mask,rest_mask),axis=1)
 			eps=1e-6
-			predictions=predictions-eps*a_mask
-
-
-			sort_idx = (-predictions).argsort(axis=1,kind='mergesort') # mergesort keeps the order
+			predictions = predictions.astype(np.float64)  # a copy: eps is below the resolution of float32 scores
+			predictions[:, :pos_num_max] -= eps
+
+			# only the top max(topk) candidates are sorted: partition first, then sort the head of each row
+			n_top = min(max(topk), predictions.shape[1])
+			sort_idx = np.argpartition(-predictions, n_top - 1, axis=1)[:, :n_top] if n_top < predictions.shape[1] \
+				else np.tile(np.arange(n_top), (len(predictions), 1))
+			head_order = np.argsort(-np.take_along_axis(predictions, sort_idx, axis=1), axis=1, kind='mergesort')
+			sort_idx = np.take_along_axis(sort_idx, head_order, axis=1)
 			if check_sort_idx==1:
 				logging.info(str(sort_idx[:10]))
-			
+
 			neg_num_max = len(predictions[0])-pos_num_max
-			pos_num_cliped = np.array(pos_num)
-			pos_num_cliped[pos_num_cliped > pos_num_max] = pos_num_max
-			neg_num_cliped = np.array(neg_num)
-			neg_num_cliped[neg_num_cliped > neg_num_max] = neg_num_max
+			pos_num_cliped = np.minimum(np.array(pos_num), pos_num_max)
+			neg_num_cliped = np.minimum(np.array(neg_num), neg_num_max)
 			whole_len = pos_num_cliped + neg_num_cliped
 
-			labels = (np.arange(max(max(pos_num_cliped),pos_num_max)) < pos_num_cliped[:, None]).astype(int)
-			labels = np.concatenate((labels,np.zeros_like(labels)),axis=1)
-			labels = np.take_along_axis(labels, sort_idx, axis=1)
+			# labels in rank order, the ranks beyond the valid candidates of a row do not count
+			labels = (sort_idx < pos_num_cliped[:, None]) & (np.arange(n_top) < whole_len[:, None])
+			positions = np.arange(1, n_top + 1)
+			discounts = 1 / np.log2(positions + 1)
+			hits = np.cumsum(labels, axis=1)
+			dcg = np.cumsum(labels * discounts, axis=1)
+			ideal_dcg = np.cumsum(discounts)
+			precision_sum = np.cumsum(labels * hits / positions, axis=1)
 
+			results = {'NDCG': dict(), 'MAP': dict(), 'HR': dict()}
 			for k in topk:
-				ndcg = NDCG_at_k(labels, whole_len, k)
-				if ret_all == 0: 
-					evaluations['NDCG@{}'.format(k)] = ndcg.mean()
-				else:
-					evaluations['NDCG@{}'.format(k)] = ndcg
-			
-			for k in topk:
-				map = AP_at_k(labels, whole_len, k)
-				if ret_all == 0: 
-					evaluations['MAP@{}'.format(k)] = map.mean()
-				else:
-					evaluations['MAP@{}'.format(k)] = map
+				k_idx = min(k, n_top) - 1
+				n_ideal = np.minimum(pos_num_cliped, k_idx + 1)
+				results['NDCG'][k] = dcg[:, k_idx] / np.where(n_ideal > 0, ideal_dcg[np.maximum(n_ideal - 1, 0)], 1)
+				# when have more than k positives, attention
+				results['MAP'][k] = precision_sum[:, k_idx] / np.clip(pos_num_cliped, 1, k)
+				# Hit rate at k: one positive before k then hitrate of this list is 1
+				results['HR'][k] = (hits[:, k_idx] > 0).astype(float)
+			for metric in ['NDCG', 'MAP', 'HR']:
+				for k in topk:
+					value = results[metric][k]
+					evaluations['{}@{}'.format(metric, k)] = value.mean() if ret_all == 0 else value
 
-			for k in topk:
-				hr = HR_at_k(labels, whole_len, k)
-				if ret_all == 0:
-					evaluations['HR@{}'.format(k)] = hr.mean()
-				else:
-					evaluations['HR@{}'.format(k)] = hr
-  
 		return evaluations
 
-	def evaluate(self, data: BaseModel.Dataset, topks: list, metrics: list, check_sort_idx = 0, all = 0) -> Dict[str, float]:
+	def _history_pairs(self, data: BaseModel.Dataset):
+		"""
+		(row, item) pairs of the historical items of each row's user, masked in full ranking
+		"""
+		if self.his_index is None:
+			corpus = data.corpus
+			his_sets = {u: set(x[0] for x in his) for u, his in corpus.user_his.items()}
+			self.his_index = sampling.CSRIndex(his_sets, corpus.n_users, corpus.n_items)
+		return self.his_index.pairs(np.array(data.data['user_id']))
+
+	def evaluate(self, data: BaseModel.Dataset, topks: list, metrics: list, check_sort_idx = 0, all = 0, predictions = None) -> Dict[str, float]:
 		"""
 		Evaluate the results for an input dataset.
+		:param predictions: output of predict on the dataset, if already computed (left unchanged)
 		:return: result dict (key: metric@k)
 		"""
-		predictions = self.predict(data)
+		if predictions is None:
+			predictions = self.predict(data)
+			if not predictions.flags.writeable:  # memory-mapped from the prediction cache
+				predictions = np.array(predictions)
+		else:
+			predictions = predictions.copy()
 		if data.model.test_all:
-			rows, cols = list(), list()
-			for i, u in enumerate(data.data['user_id']):
-				clicked_items = [x[0] for x in data.corpus.user_his[u]]
-				# clicked_items = [data.data['item_id'][i]]
-				idx = list(np.ones_like(clicked_items) * i)
-				rows.extend(idx)
-				cols.extend(clicked_items)
+			rows, cols = self._history_pairs(data)
 			predictions[rows, cols] = -np.inf
 
-		rows, cols = list(), list()
-		mask = np.full_like(predictions, 0)
-		if 'pos_num' not in data.data.keys():
-			pos_num=[1 for i in range(len(predictions))]
-		else:
-			pos_num=data.data['pos_num']
-		neg_num=data.data['neg_num']
-		mp = data.model.test_max_pos_item
-		mn = data.model.test_max_neg_item
-		for i in range(len(data.data['neg_num'])):
-			rows.extend([i for _ in range(min(pos_num[i], mp))])
-			rows.extend([i for _ in range(min(neg_num[i], mn))])
-			cols.extend([_ for _ in range(min(pos_num[i], mp))])
-			cols.extend([_ for _ in range(mp, mp+min(neg_num[i], mn))])
-		mask[rows, cols] = 1
-
-		predictions = np.where(mask == 1, predictions, -np.inf)
-		if 'pos_num' in data.data.keys():
-			return self.evaluate_method(predictions, topks, metrics, data.model.test_all, data.data['neg_num'], mp, data.data['pos_num'], check_sort_idx, test_num_neg=data.neg_len, ret_all=all)
-		else:
-			return self.evaluate_method(predictions, topks, metrics, data.model.test_all, data.data['neg_num'], mp, check_sort_idx, test_num_neg=data.neg_len, ret_all=all)
-	
+		pos_max, neg_max = data.model.test_max_pos_item, data.model.test_max_neg_item
+		pos_num = np.ones(len(predictions), dtype=int) if 'pos_num' not in data.data.keys() else np.array(data.data['pos_num'])
+		neg_num = np.array(data.data['neg_num'])
+		columns = np.arange(predictions.shape[1])[None, :]
+		mask = (columns < np.minimum(pos_num, pos_max)[:, None]) | \
+			((columns >= pos_max) & (columns < pos_max + np.minimum(neg_num, neg_max)[:, None]))
+		predictions = np.where(mask, predictions, -np.inf)
+		return self.evaluate_method(predictions, topks, metrics, data.model.test_all, neg_num, pos_max, pos_num,
+									check_sort_idx=check_sort_idx, test_num_neg=data.neg_len, ret_all=all)
+
+
+	def row_results(self, dataset: BaseModel.Dataset, predictions=None) -> Dict[str, np.ndarray]:
+		"""
+		With several positives per row, the per-row metric vectors (NDCG, MAP and HR@k) are kept instead of ranks.
+		"""
+		rows = self.evaluate(dataset, self.topk, self.metrics, all=1, predictions=predictions)
+		rows = {key: np.asarray(value, dtype=np.float32) for key, value in rows.items()}
+		rows['user_id'] = np.asarray(dataset.data['user_id'], dtype=np.int32)
+		return rows
+
 	def fit(self, data: BaseModel.Dataset, epoch = -1) -> float:
 		model = data.model
 		if model.optimizer is None:
 			model.optimizer = self._build_optimizer(model)
-		data.actions_before_epoch()  # must sample before multi thread start
+		self._compile_model(model)
+		self._actions_before_epoch(data)  # must sample before multi thread start
 
 		model.train()
 		loss_lst = list()
-		dl = DataLoader(data, batch_size = self.batch_size, shuffle = True, num_workers = self.num_workers,
+		dl = DataLoader(data, batch_size = self._train_batch_size(), shuffle = True, num_workers = self.num_workers,
 						collate_fn = data.collate_batch, pin_memory=self.pin_memory)
 		for batch in tqdm(dl, leave = False, desc = 'Epoch {:<3}'.format(epoch), ncols = 100, mininterval = 1):
 			batch = utils.batch_to_gpu(batch, model.device)
 			model.optimizer.zero_grad()
-			out_dict = model(batch)
+			with self._autocast(model.device):
+				out_dict = model(batch)
 			max_pos_num = model.train_max_pos_item
 			pos_mask = 2*(torch.arange(max_pos_num)[None, :].to(model.device) < batch['pos_num'][:, None]).int()-1
 			neg_mask = (torch.arange(out_dict['prediction'].size(1) - max_pos_num)[None, :].to(model.device) < batch['neg_num'][:, None]).int() - 1
 			labels = torch.cat([pos_mask, neg_mask], dim = -1)
-			loss = model.loss(out_dict, labels)
+			loss = self._model_loss(model, out_dict, labels)
 			if loss.isnan() or loss.isinf() or out_dict['prediction'].isnan().any() or out_dict['prediction'].isinf().any():
 				logging.info("Loss is Nan. Stop training at %d."%(epoch + 1))
 			loss.backward()
-			model.optimizer.step()
+			self._optimizer_step(model)
 			loss_lst.append(loss.detach().cpu().data.numpy())
-		return np.mean(loss_lst).item()
+		return self._epoch_loss(loss_lst)
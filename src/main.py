@@ -5,7 +5,7 @@ import sys
 import pickle
 import logging
 import argparse
-import pandas as pd
+import numpy as np
 import torch
 
 from helpers import *
@@ -31,6 +31,8 @@ def parse_global_args(parser):
 						help='Whether load model and continue to train')
 	parser.add_argument('--train', type=int, default=1,
 						help='To train the model or not.')
+	parser.add_argument('--test_before_train', type=int, default=1,
+						help='Whether to evaluate on test before training (with --train 0, the final test results are reused).')
 	parser.add_argument('--save_final_results', type=int, default=1,
 						help='To save the final validation and test results or not.')
 	parser.add_argument('--regenerate', type=int, default=0,
@@ -77,77 +79,83 @@ def main():
 
 	# Run model
 	runner = runner_name(args)
-	logging.info('Test Before Training: ' + runner.print_res(data_dict['test']))
+	if args.test_before_train and args.train > 0:
+		logging.info('Test Before Training: ' + runner.print_res(data_dict['test']))
 	if args.load > 0:
 		model.load_model()
 	if args.train > 0:
 		runner.train(data_dict)
 
-	# Evaluate final results
-	eval_res = runner.print_res(data_dict['dev'])
+	# Evaluate final results, each split is predicted once for metrics and saved results
+	if init_args.model_mode in ['TopK', '']:  # stream ground-truth ranks and top-k instead of all scores
+		predictions = {phase: runner.predict_topk(data_dict[phase], 100) for phase in ['dev', 'test']}
+	else:
+		predictions = {phase: runner.predict(data_dict[phase]) for phase in ['dev', 'test']}
+	eval_res = runner.print_res(data_dict['dev'], predictions['dev'])
 	logging.info(os.linesep + 'Dev  After Training: ' + eval_res)
-	eval_res = runner.print_res(data_dict['test'])
+	eval_res = runner.print_res(data_dict['test'], predictions['test'])
+	if args.test_before_train and args.train == 0 and args.load == 0:  # the same weights as before training
+		logging.info('Test Before Training: ' + eval_res)
 	logging.info(os.linesep + 'Test After Training: ' + eval_res)
+	if runner.save_rows:  # per-row results for offline significance tests
+		for phase in ['dev', 'test']:
+			runner.save_row_results(data_dict[phase], predictions[phase])
 	if args.save_final_results==1: # save the prediction results
-		save_rec_results(data_dict['dev'], runner, 100)
-		save_rec_results(data_dict['test'], runner, 100)
+		save_rec_results(data_dict['dev'], runner, 100, predictions['dev'])
+		save_rec_results(data_dict['test'], runner, 100, predictions['test'])
 	model.actions_after_train()
 	logging.info(os.linesep + '-' * 45 + ' END: ' + utils.get_time() + ' ' + '-' * 45)
 
 
-def save_rec_results(dataset, runner, topk):
+def save_rec_results(dataset, runner, topk, predictions=None):
+	if predictions is None:
+		predictions = runner.predict_topk(dataset, topk) if init_args.model_mode in ['TopK', ''] else runner.predict(dataset)
 	model_name = '{0}{1}'.format(init_args.model_name,init_args.model_mode)
-	result_path = os.path.join(runner.log_path,runner.save_appendix, 'rec-{}-{}.csv'.format(model_name,dataset.phase))
-	utils.check_dir(result_path)
+	result_path = os.path.join(runner.log_path,runner.save_appendix, 'rec-{}-{}'.format(model_name,dataset.phase))
 
-	if init_args.model_mode == 'CTR': # CTR task 
+	data = dataset.data
+	user_column = lambda start, end: np.asarray(data['user_id'][start:end], dtype=np.int32)
+	# all the exports are written in chunks of rows, so that memory stays bounded by a chunk
+	if init_args.model_mode == 'CTR': # CTR task, columns: user_id, item_id, pCTR, label
+		result_path += '.npz'
 		logging.info('Saving CTR prediction results to: {}'.format(result_path))
-		predictions, labels = runner.predict(dataset)
-		users, items= list(), list()
-		for i in range(len(dataset)):
-			info = dataset[i]
-			users.append(info['user_id'])
-			items.append(info['item_id'][0])
-		rec_df = pd.DataFrame(columns=['user_id', 'item_id', 'pCTR', 'label'])
-		rec_df['user_id'] = users
-		rec_df['item_id'] = items
-		rec_df['pCTR'] = predictions
-		rec_df['label'] = labels
-		rec_df.to_csv(result_path, sep=args.sep, index=False)
-	elif init_args.model_mode in ['TopK','']: # TopK Ranking task
+		predictions, labels = predictions
+		predictions = np.asarray(predictions).reshape(-1)
+		utils.save_npz_chunks(result_path, len(dataset), {
+			'user_id': user_column,
+			'item_id': lambda start, end: np.asarray(data['item_id'][start:end], dtype=np.int32),
+			'pCTR': lambda start, end: predictions[start:end].astype(np.float32),
+			'label': lambda start, end: np.asarray(labels[start:end], dtype=np.float32)})
+	elif init_args.model_mode in ['TopK','']: # TopK Ranking task, columns: user_id, rec_items and rec_predictions (-1, topk)
+		result_path += '.npz'
 		logging.info('Saving top-{} recommendation results to: {}'.format(topk, result_path))
-		predictions = runner.predict(dataset)  # n_users, n_candidates
-		users, rec_items, rec_predictions = list(), list(), list()
-		for i in range(len(dataset)):
-			info = dataset[i]
-			users.append(info['user_id'])
-			item_scores = zip(info['item_id'], predictions[i])
-			sorted_lst = sorted(item_scores, key=lambda x: x[1], reverse=True)[:topk]
-			rec_items.append([x[0] for x in sorted_lst])
-			rec_predictions.append([x[1] for x in sorted_lst])
-		rec_df = pd.DataFrame(columns=['user_id', 'rec_items', 'rec_predictions'])
-		rec_df['user_id'] = users
-		rec_df['rec_items'] = rec_items
-		rec_df['rec_predictions'] = rec_predictions
-		rec_df.to_csv(result_path, sep=args.sep, index=False)
+		if 'item_id' not in predictions:  # only ranks were kept
+			predictions = runner.predict_topk(dataset, topk)
+		utils.save_npz_chunks(result_path, len(dataset), {
+			'user_id': user_column,
+			'rec_items': lambda start, end: predictions['item_id'][start:end, :topk],
+			'rec_predictions': lambda start, end: predictions['score'][start:end, :topk].astype(np.float32)})
 	elif init_args.model_mode in ['Impression','General','Sequential']: # List-wise reranking task: Impression is reranking task for general/seq baseranker. General/Sequential is reranking task for rerankers with general/sequential input.
+		# columns: user_id, pos_items/pos_predictions (-1, pos_len) and neg_items/neg_predictions (-1, neg_len)
+		# padded with 0, and the number of valid items of each row pos_num/neg_num
+		result_path += '.npz'
 		logging.info('Saving all recommendation results to: {}'.format(result_path))
-		predictions = runner.predict(dataset)  # n_users, n_candidates
-		users, pos_items, pos_predictions, neg_items, neg_predictions= list(), list(), list(), list(), list()
-		for i in range(len(dataset)):
-			info = dataset[i]
-			users.append(info['user_id'])
-			pos_items.append(info['pos_items'])
-			neg_items.append(info['neg_items'])
-			pos_predictions.append(predictions[i][:dataset.pos_len])
-			neg_predictions.append(predictions[i][:dataset.neg_len])
-		rec_df = pd.DataFrame(columns=['user_id', 'pos_items', 'pos_predictions', 'neg_items', 'neg_predictions'])
-		rec_df['user_id'] = users
-		rec_df['pos_items'] = pos_items
-		rec_df['pos_predictions'] = pos_predictions
-		rec_df['neg_items'] = neg_items
-		rec_df['neg_predictions'] = neg_predictions
-		rec_df.to_csv(result_path, sep=args.sep, index=False)
+		# predictions: n_users, pos_len + neg_len (positive items then negative items of each row, both padded)
+		pos_len, neg_len = dataset.pos_len, dataset.neg_len
+		if dataset.model.test_all:  # the first neg_len items of the catalog for every row
+			catalog = np.arange(1, min(dataset.corpus.n_items, neg_len + 1))
+			neg_column = lambda start, end: utils.pad_rows([catalog] * (end - start), neg_len, np.int32)
+		else:
+			neg_column = lambda start, end: utils.pad_rows(data['neg_items'][start:end], neg_len, np.int32)
+		utils.save_npz_chunks(result_path, len(dataset), {
+			'user_id': user_column,
+			'pos_items': lambda start, end: utils.pad_rows(data['pos_items'][start:end], pos_len, np.int32),
+			'pos_predictions': lambda start, end: np.asarray(predictions[start:end, :pos_len], dtype=np.float32),
+			'neg_items': neg_column,
+			'neg_predictions': lambda start, end: np.asarray(
+				predictions[start:end, pos_len:pos_len + neg_len], dtype=np.float32),
+			'pos_num': lambda start, end: np.minimum(np.asarray(data['pos_num'][start:end]), pos_len).astype(np.int32),
+			'neg_num': lambda start, end: np.minimum(np.asarray(data['neg_num'][start:end]), neg_len).astype(np.int32)})
 	else:
 		return 0
 	logging.info("{} Prediction results saved!".format(dataset.phase))
@@ -2,7 +2,8 @@ import pandas as pd
 import pickle
 import os
 import numpy as np
-import random
+
+from utils import sampling
 
 # ==================== 📂 路径配置 ====================
 # 1. 原始数据目录
@@ -11,6 +12,8 @@ BASE_DATA_DIR = r'../Agent4Rec-master/datasets/ml-1m/cf_data'
 PKL_FOLDER_PATH = r'..\Agent4Rec-master\storage\ml-1m\LightGCN\lgn_1000_5_4_1009\behavior_clean'
 # 3. 输出目录
 RECHORUS_DATA_ROOT = '../data'
+# 4. 负采样随机种子
+RANDOM_SEED = 0
 # ====================================================
 
 def read_cf_txt(filepath):
@@ -58,27 +61,32 @@ def parse_agent_data_all(folder_path):
     return pd.DataFrame(new_interactions, columns=['user_id', 'item_id'])
 
 def generate_negative_samples(df_target, global_history, all_items, num_neg=99):
+    """
+    向量化生成负样本：批量采样，排序索引排除看过的物品 (不修改 global_history)，返回 int32 [n_rows, num_neg] 矩阵
+    """
     print(f"🎲 生成负样本...")
-    neg_lists = []
-    all_items_list = list(all_items)
-    for idx, row in df_target.iterrows():
-        u, i = row['user_id'], row['item_id']
-        seen = global_history.get(u, set())
-        seen.add(i)
-        samples = []
-        while len(samples) < num_neg:
-            candidates = random.sample(all_items_list, min(len(all_items_list), num_neg * 2))
-            for cand in candidates:
-                if cand not in seen and cand not in samples:
-                    samples.append(cand)
-                    if len(samples) == num_neg: break
-        neg_lists.append(str(samples))
-    return neg_lists
+    pool = np.array(sorted(all_items), dtype=np.int64)
+    users = df_target['user_id'].to_numpy(dtype=np.int64)
+    items = df_target['item_id'].to_numpy(dtype=np.int64)
+    n_rows = int(max(max(global_history, default=0), users.max(initial=0))) + 1
+    n_cols = int(max(max((max(h) for h in global_history.values() if len(h)), default=0),
+                     pool.max(initial=0), items.max(initial=0))) + 1
+    seen = sampling.CSRIndex(global_history, n_rows, n_cols)
+    collide = lambda rows, cands: seen.contains(users[rows], cands) | (cands == items[rows])
+    draw = lambda size: pool[np.random.randint(len(pool), size=size)]
+    # 可选物品不足 num_neg 的行会让拒绝采样永不结束，采样前检查并报错
+    n_available = sampling.count_available(seen, users, pool, items)
+    neg_items = sampling.reject_sample_unique(np.arange(len(df_target)), num_neg, draw, collide, n_available)
+    return neg_items.astype(np.int32)
 
-def save_dataset(df_train, df_valid, df_test, folder_name):
+def save_dataset(df_train, df_valid, df_test, folder_name, neg_valid=None, neg_test=None):
     target_dir = os.path.join(RECHORUS_DATA_ROOT, folder_name)
     if not os.path.exists(target_dir): os.makedirs(target_dir)
     print(f"💾 保存数据集至: {target_dir}")
+
+    # 负样本矩阵另存为二进制文件，行与 dev.csv / test.csv 一一对应
+    if neg_valid is not None: np.save(os.path.join(target_dir, 'dev_neg_items.npy'), neg_valid)
+    if neg_test is not None: np.save(os.path.join(target_dir, 'test_neg_items.npy'), neg_test)
     
     df_train[['user_id', 'item_id', 'time']].to_csv(
         os.path.join(target_dir, 'train.csv'), sep='\t', index=False, header=['user_id', 'item_id', 'time'])
@@ -133,11 +141,14 @@ def main():
         global_hist[u].add(i)
 
     # 生成负样本
-    df_valid_orig['neg_items'] = generate_negative_samples(df_valid_orig, global_hist, all_items)
-    df_test_orig['neg_items'] = generate_negative_samples(df_test_orig, global_hist, all_items)
+    np.random.seed(RANDOM_SEED)
+    neg_valid = generate_negative_samples(df_valid_orig, global_hist, all_items)
+    neg_test = generate_negative_samples(df_test_orig, global_hist, all_items)
+    df_valid_orig['neg_items'] = [str(x) for x in neg_valid.tolist()]
+    df_test_orig['neg_items'] = [str(x) for x in neg_test.tolist()]
 
     # 5. 保存
-    save_dataset(df_train_variant_a, df_valid_orig, df_test_orig, 'Agent4Rec_All')
+    save_dataset(df_train_variant_a, df_valid_orig, df_test_orig, 'Agent4Rec_All', neg_valid, neg_test)
     
     print("✅ 完成！请使用数据集 'Agent4Rec_All' 运行消融实验。")
 
@@ -27,6 +27,19 @@ def get_context_feature(feed_dict, index, corpus, data):
 			feed_dict[c] = np.array([corpus.item_features[iid][c] for iid in feed_dict['item_id']])
 	return feed_dict
 
+def append_catalog_feature(feed_dict, dataset):
+	"""
+	Append the item features of the catalog to those of the targets in a collated batch, for full ranking (test_all)
+	"""
+	corpus = dataset.corpus
+	if not hasattr(dataset, 'catalog_features'):  # built once per dataset, shared by all the rows
+		dataset.catalog_features = {c: torch.tensor([corpus.item_features[iid][c] for iid in range(1, corpus.n_items)])
+									for c in corpus.item_feature_names}
+	for c, features in dataset.catalog_features.items():
+		target = feed_dict[c][:, :1]
+		feed_dict[c] = torch.cat([target, features.to(target.dtype).expand(target.shape[0], -1)], dim=1)
+	return feed_dict
+
 class ContextModel(GeneralModel):
 	# context model for top-k recommendation tasks
 	reader = 'ContextReader'
@@ -69,6 +82,10 @@ class ContextModel(GeneralModel):
 			feed_dict = get_context_feature(feed_dict, index, self.corpus, self.data)
 			return feed_dict
 
+		def _append_catalog(self, feed_dict):
+			feed_dict = super()._append_catalog(feed_dict)
+			return append_catalog_feature(feed_dict, self)
+
 
 class ContextCTRModel(CTRModel):
 	# context model for CTR prediction tasks
@@ -123,6 +140,10 @@ class ContextSeqModel(ContextModel):
 			feed_dict.pop('history_items')
 			return feed_dict
 
+		def _append_catalog(self, feed_dict):
+			feed_dict = super()._append_catalog(feed_dict)
+			return append_catalog_feature(feed_dict, self)
+
 class ContextSeqCTRModel(ContextCTRModel):
 	reader = 'ContextSeqReader'
 	
@@ -35,12 +35,17 @@ class ImpressionModel(GeneralModel):
 
 	def __init__(self, args, corpus):
 		super().__init__(args,corpus)
+		if self.neg_sampler == 'inbatch':  # negatives come from the impression lists, there is no item_id target column
+			raise ValueError('Negative sampler inbatch is not supported by impression models.')
 		self.loss_n = args.loss_n
 		self.train_max_pos_item=args.train_max_pos_item
 		self.test_max_pos_item=args.test_max_pos_item
 		self.test_max_neg_item=args.test_max_neg_item
 		self.train_max_neg_item=args.train_max_neg_item
 
+	def catalog_scoring(self) -> bool:
+		return False  # candidates are the impression lists
+
 	def loss(self, out_dict: dict, target=None):
 		#multiple choices of list-wize ranking loss with optimization on multiple positive/negative samples
 		prediction = out_dict['prediction'] # [batch_size, max_length_of_candidate_list]
@@ -165,7 +170,7 @@ class ImpressionModel(GeneralModel):
 		def _get_feed_dict(self, index): # get feed dict with postive and negative samples and their actual length
 			user_id, target_item = self.data['user_id'][index], self.data['pos_items'][index]
 			if self.phase != 'train' and self.model.test_all:
-				neg_items = np.arange(1, self.corpus.n_items)
+				neg_items = np.arange(1, min(self.corpus.n_items, self.neg_len + 1))  # only the first neg_len are kept
 			#if self.phase != 'train': # test negative sampling
 				#neg_items = np.random.randint(1, self.corpus.n_items, size=20)
 			else: # mostly this situation, customizing the neg items in evaluation
@@ -180,6 +185,10 @@ class ImpressionModel(GeneralModel):
 			}
 			return feed_dict
 		
+		# The candidates of full ranking are already cut to neg_len per row
+		def _append_catalog(self, feed_dict: dict) -> dict:
+			return feed_dict
+
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]):
 			feed_dict = super().collate_batch(feed_dicts)
@@ -252,6 +261,9 @@ class ImpressionSeqModel(ImpressionModel):
 			feed_dict['neg_lengths'] = len(feed_dict['neg_history_items'])
 			return feed_dict
 		
+		def _append_catalog(self, feed_dict: dict) -> dict:
+			return ImpressionModel.Dataset._append_catalog(self, feed_dict)
+
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]):
 			feed_dict = super().collate_batch(feed_dicts)
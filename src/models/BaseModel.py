@@ -11,11 +11,14 @@ from torch.nn.utils.rnn import pad_sequence
 from typing import List
 
 from utils import utils
+from utils import sampling
 from helpers.BaseReader import BaseReader
 
 class BaseModel(nn.Module):
 	reader, runner = None, None  # choose helpers in specific model classes
 	extra_log_args = []
+	shuffle_candidates = False  # models reading candidate positions (e.g., the first column) get candidates permuted in training
+	sparse_embeddings = []  # names of nn.Embedding modules only used through lookups, which can have sparse gradients
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -72,6 +75,16 @@ class BaseModel(nn.Module):
 		optimize_dict = [{'params': weight_p}, {'params': bias_p, 'weight_decay': 0}]
 		return optimize_dict
 
+	def enable_sparse_embeddings(self) -> list:
+		# switch the embeddings in sparse_embeddings to sparse gradients and return their trainable weights
+		params = list()
+		for name in self.sparse_embeddings:
+			embedding = getattr(self, name)
+			embedding.sparse = True
+			if embedding.weight.requires_grad:
+				params.append(embedding.weight)
+		return params
+
 	def save_model(self, model_path=None):
 		if model_path is None:
 			model_path = self.model_path
@@ -113,7 +126,7 @@ class BaseModel(nn.Module):
 			return len(self.data)
 
 		def __getitem__(self, index: int) -> dict:
-			if self.model.buffer and self.phase != 'train':
+			if self._buffered():
 				return self.buffer_dict[index]
 			return self._get_feed_dict(index)
 
@@ -121,9 +134,13 @@ class BaseModel(nn.Module):
 		def _get_feed_dict(self, index: int) -> dict:
 			pass
 
+		# Whether the feed dicts of dev/test are built once and kept in memory
+		def _buffered(self) -> bool:
+			return self.model.buffer and self.phase != 'train'
+
 		# Called after initialization
 		def prepare(self):
-			if self.model.buffer and self.phase != 'train':
+			if self._buffered():
 				for i in tqdm(range(len(self)), leave=False, desc=('Prepare ' + self.phase)):
 					self.buffer_dict[i] = self._get_feed_dict(i)
 
@@ -162,6 +179,12 @@ class GeneralModel(BaseModel):
 							help='Dropout probability for each deep layer')
 		parser.add_argument('--test_all', type=int, default=0,
 							help='Whether testing on all the items.')
+		parser.add_argument('--neg_sampler', type=str, default='uniform',
+							help='Negative sampler during training: uniform, pop, inbatch, mixed (pop + uniform)')
+		parser.add_argument('--neg_alpha', type=float, default=0.75,
+							help='Exponent on item popularity for the pop sampler.')
+		parser.add_argument('--neg_mix', type=float, default=0.5,
+							help='Ratio of pop negatives for the mixed sampler.')
 		return BaseModel.parse_model_args(parser)
 
 	def __init__(self, args, corpus):
@@ -171,6 +194,19 @@ class GeneralModel(BaseModel):
 		self.num_neg = args.num_neg
 		self.dropout = args.dropout
 		self.test_all = args.test_all
+		self.neg_sampler = args.neg_sampler
+		self.neg_alpha = args.neg_alpha
+		self.neg_mix = args.neg_mix
+		if self.neg_sampler not in sampling.NEG_SAMPLERS:
+			raise ValueError('Undefined negative sampler: {}.'.format(self.neg_sampler))
+
+	def catalog_scoring(self) -> bool:
+		"""
+		Whether full ranking (test_all) scores the whole catalog from representations instead of candidate lists:
+		models implementing user_representation(feed_dict) -> [batch_size, emb_size] and
+		item_representations() -> [n_items, emb_size], whose prediction is the dot product of the two.
+		"""
+		return self.test_all > 0 and hasattr(self, 'user_representation') and hasattr(self, 'item_representations')
 
 	def loss(self, out_dict: dict) -> torch.Tensor:
 		"""
@@ -189,10 +225,24 @@ class GeneralModel(BaseModel):
 		return loss
 
 	class Dataset(BaseModel.Dataset):
+		# whether the candidates of a row carry features depending on the row (e.g., time intervals w.r.t. the history),
+		# so that full ranking (test_all) has to build the whole catalog per row instead of per batch
+		catalog_per_row = False
+
+		def _buffered(self) -> bool:
+			# rows holding the whole catalog would take O(#rows * #items) memory
+			return super()._buffered() and not (self.model.test_all and self.catalog_per_row)
+
+		def _full_ranking(self) -> bool:
+			return self.phase != 'train' and self.model.test_all and not self.model.catalog_scoring()
+
 		def _get_feed_dict(self, index):
 			user_id, target_item = self.data['user_id'][index], self.data['item_id'][index]
-			if self.phase != 'train' and self.model.test_all:
+			if self._full_ranking() and self.catalog_per_row:
 				neg_items = np.arange(1, self.corpus.n_items)
+			elif self.phase != 'train' and self.model.test_all:
+				# all the items are scored by the runner (catalog_scoring) or appended per batch in collate_batch
+				neg_items = np.array([], dtype=int)
 			else:
 				neg_items = self.data['neg_items'][index]
 			item_ids = np.concatenate([[target_item], neg_items]).astype(int)
@@ -204,14 +254,28 @@ class GeneralModel(BaseModel):
 
 		# Sample negative items for all the instances
 		def actions_before_epoch(self):
-			neg_items = np.random.randint(1, self.corpus.n_items, size=(len(self), self.model.num_neg))
-			for i, u in enumerate(self.data['user_id']):
-				clicked_set = self.corpus.train_clicked_set[u]  # neg items are possible to appear in dev/test set
-				# clicked_set = self.corpus.clicked_set[u]  # neg items will not include dev/test set
-				for j in range(self.model.num_neg):
-					while neg_items[i][j] in clicked_set:
-						neg_items[i][j] = np.random.randint(1, self.corpus.n_items)
-			self.data['neg_items'] = neg_items
+			if not hasattr(self, 'neg_sampler'):
+				self.neg_sampler = sampling.build_neg_sampler(
+					self.model.neg_sampler, self.corpus, self.model.neg_alpha, self.model.neg_mix)
+			self.data['neg_items'] = self.neg_sampler.sample(self.data['user_id'], self.model.num_neg)
+
+		def collate_batch(self, feed_dicts: List[dict]) -> dict:
+			feed_dict = super().collate_batch(feed_dicts)
+			if self.phase == 'train' and self.model.neg_sampler == 'inbatch':  # share the targets of the batch as negatives
+				item_ids = feed_dict['item_id']
+				neg_items = self.neg_sampler.sample_in_batch(
+					feed_dict['user_id'].numpy(), item_ids[:, 0].numpy(), item_ids.shape[1] - 1)
+				feed_dict['item_id'] = torch.cat([item_ids[:, :1], torch.from_numpy(neg_items).to(item_ids.dtype)], dim=1)
+			if self._full_ranking() and not self.catalog_per_row:
+				feed_dict = self._append_catalog(feed_dict)
+			return feed_dict
+
+		# Full ranking: append the catalog (column j > 0 holds item j) to the target of each row of a collated batch
+		def _append_catalog(self, feed_dict: dict) -> dict:
+			item_ids = feed_dict['item_id']
+			catalog = torch.arange(1, self.corpus.n_items, dtype=item_ids.dtype)
+			feed_dict['item_id'] = torch.cat([item_ids[:, :1], catalog.expand(item_ids.shape[0], -1)], dim=1)
+			return feed_dict
 
 class SequentialModel(GeneralModel):
 	reader = 'SeqReader'
@@ -1,6 +1,9 @@
+import os
 import torch
+import logging
 import numpy as np
 import torch.nn.functional as F
+from tqdm import tqdm
 from typing import List
 import yaml
 import copy
@@ -27,6 +30,8 @@ class RerankModel(ImpressionModel):
 							help='Base ranker model file')
 		parser.add_argument('--tuneranker', type=int, default=0,
 							help='if 1, continue to train ranker')
+		parser.add_argument('--cache_ranker', type=int, default=0,
+							help='if 1 (and tuneranker=0), score every impression with the frozen ranker once and read the cached outputs afterwards')
 		return ImpressionModel.parse_model_args(parser)
 
 	def __init__(self, args, corpus):
@@ -35,6 +40,9 @@ class RerankModel(ImpressionModel):
 		self.ranker_config = args.ranker_config_file
 		self.ranker_model = args.ranker_model_file
 		self.tuneranker = args.tuneranker
+		self.cache_ranker = args.cache_ranker and not self.tuneranker # a ranker being tuned cannot be cached
+		self.cache_batch_size = args.eval_batch_size
+		self.regenerate = args.regenerate
 		self.load_ranker(args, corpus)
 
 	def load_ranker(self, args, corpus):
@@ -43,6 +51,8 @@ class RerankModel(ImpressionModel):
 		# model_path = './{}'.format(self.ranker_model)
 		config_path = './model/{}Impression/{}'.format(self.ranker_name,self.ranker_config)
 		model_path = './model/{}Impression/{}'.format(self.ranker_name,self.ranker_model)
+		self.ranker_cache_dir = './model/{}Impression/cache/{}'.format(self.ranker_name,os.path.splitext(self.ranker_model)[0])
+		self.ranker_model_path = model_path
 		#read ranker config
 		ranker_config_dict = dict()
 		with open(config_path, "r", encoding="utf-8") as f:
@@ -65,13 +75,70 @@ class RerankModel(ImpressionModel):
 			for param in self.ranker.parameters():
 				param.requires_grad = False
 
-	class Dataset(ImpressionModel.Dataset):		
-		# Collate a batch according to the list of feed dicts
-		def collate_batch(self, feed_dicts: List[dict]) -> dict: # feed_dicts are a batch of dicts
-			feed_dict = super().collate_batch(feed_dicts)
-			feed_dict['batch_size'] = len(feed_dicts)
-			predict_dict = self.model.ranker(utils.batch_to_gpu(feed_dict, self.model.device)) # pos+pad+neg+pad
-			feed_dict['scores'] = predict_dict['prediction'] # [batch(or num_sequence),n_candidate]
+	class Dataset(ImpressionModel.Dataset):
+		def __getitem__(self, index: int) -> dict:
+			feed_dict = BaseModel.Dataset.__getitem__(self, index)
+			if self.model.cache_ranker:
+				feed_dict['row_id'] = index # key to look up the cached ranker outputs
+			return feed_dict
+
+		def prepare(self):
+			super().prepare()
+			if self.model.cache_ranker:
+				RerankModel.Dataset._load_ranker_cache(self, ImpressionModel.Dataset.collate_batch)
+
+		def _load_ranker_cache(self, base_collate, his_len=0):
+			"""
+			Score every impression with the frozen ranker once and keep the outputs in memory-mapped .npy files,
+			one row per impression: scores [n, n_candidate], u_v/i_v [n, n_candidate, emb], his_v [n, his_len, emb].
+			"""
+			keys = ['scores', 'u_v', 'i_v'] + (['his_v'] if his_len > 0 else [])
+			# the cache is keyed by the version (modification time and size) of the ranker checkpoint,
+			# so that a ranker retrained into the same file is scored again
+			ranker_stat = os.stat(self.model.ranker_model_path)
+			prefix = os.path.join(self.model.ranker_cache_dir, '{}__{}__{}_{}'.format(
+				self.corpus.dataset, self.phase, ranker_stat.st_mtime_ns, ranker_stat.st_size))
+			paths = {k: '{}__{}.npy'.format(prefix, k) for k in keys}
+			if not self.model.regenerate and all(os.path.exists(p) for p in paths.values()):
+				self.ranker_cache = {k: np.load(p, mmap_mode='r') for k, p in paths.items()}
+				if all(len(v) == len(self) for v in self.ranker_cache.values()) and \
+						self.ranker_cache['scores'].shape[1] == self.pos_len + self.neg_len and \
+						(his_len == 0 or self.ranker_cache['his_v'].shape[1] == his_len):  # e.g., another history_max
+					logging.info('Load ranker cache from {}'.format(prefix))
+					return
+			utils.check_dir(prefix)
+			ranker = self.model.ranker
+			ranker.eval()
+			self.ranker_cache = dict()
+			with torch.no_grad():
+				for start in tqdm(range(0, len(self), self.model.cache_batch_size), leave=False,
+								  desc='Cache ranker ' + self.phase):
+					end = min(start + self.model.cache_batch_size, len(self))
+					feed_dict = base_collate(self, [BaseModel.Dataset.__getitem__(self, i) for i in range(start, end)])
+					feed_dict['batch_size'] = end - start
+					predict_dict = ranker(utils.batch_to_gpu(feed_dict, self.model.device))
+					outputs = {'scores': predict_dict['prediction'], 'u_v': predict_dict['u_v'], 'i_v': predict_dict['i_v']}
+					if his_len > 0:
+						history = feed_dict['history_items']
+						history = F.pad(history, (0, his_len - history.shape[1])) # pad with item 0 as collate does
+						outputs['his_v'] = RerankSeqModel.Dataset._ranker_history_vectors(self, history)
+					for k, v in outputs.items():
+						v = v.float().cpu().numpy()
+						if k not in self.ranker_cache:
+							self.ranker_cache[k] = np.lib.format.open_memmap(
+								paths[k], mode='w+', dtype=np.float32, shape=(len(self),) + v.shape[1:])
+						self.ranker_cache[k][start:end] = v
+			for k in keys:
+				self.ranker_cache[k].flush()
+			self.ranker_cache = {k: np.load(p, mmap_mode='r') for k, p in paths.items()}
+			logging.info('Save ranker cache to {}'.format(prefix))
+
+		def _cached_ranker_outputs(self, feed_dict: dict) -> dict:
+			rows = feed_dict.pop('row_id').cpu().numpy()
+			return {k: torch.from_numpy(v[rows]).to(self.model.device) for k, v in self.ranker_cache.items()}
+
+		def _attach_ranker_outputs(self, feed_dict: dict, scores, u_v, i_v) -> dict:
+			feed_dict['scores'] = scores # [batch(or num_sequence),n_candidate]
 			pos_mask = torch.arange(0, self.model.train_max_pos_item, device = self.model.device).type_as(feed_dict['pos_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_pos_item).lt(feed_dict['pos_num'].unsqueeze(1))
 			neg_mask = torch.arange(0, self.model.train_max_neg_item, device = self.model.device).type_as(feed_dict['neg_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_neg_item).lt(feed_dict['neg_num'].unsqueeze(1))
 			all_mask = torch.cat([pos_mask, neg_mask],dim = 1)
@@ -79,10 +146,21 @@ class RerankModel(ImpressionModel):
 			feed_dict['scores'] = torch.where(all_mask == 1, feed_dict['scores'],-np.inf * torch.ones_like(feed_dict['scores']))
 			_,temp = feed_dict['scores'].sort(dim = 1, descending = True)
 			_,feed_dict['position'] = temp.sort(dim = 1)
-			feed_dict['u_v'] = predict_dict['u_v'] # [batch(or num_sequence),ranker_embedding_len]
-			feed_dict['i_v'] = predict_dict['i_v'] # [batch(or num_sequence),ranker_embedding_len]
+			feed_dict['u_v'] = u_v # [batch(or num_sequence),ranker_embedding_len]
+			feed_dict['i_v'] = i_v # [batch(or num_sequence),ranker_embedding_len]
 			return feed_dict
 
+		# Collate a batch according to the list of feed dicts
+		def collate_batch(self, feed_dicts: List[dict]) -> dict: # feed_dicts are a batch of dicts
+			feed_dict = super().collate_batch(feed_dicts)
+			feed_dict['batch_size'] = len(feed_dicts)
+			if self.model.cache_ranker:
+				cached = RerankModel.Dataset._cached_ranker_outputs(self, feed_dict)
+				utils.batch_to_gpu(feed_dict, self.model.device)
+				return RerankModel.Dataset._attach_ranker_outputs(self, feed_dict, cached['scores'], cached['u_v'], cached['i_v'])
+			predict_dict = self.model.ranker(utils.batch_to_gpu(feed_dict, self.model.device)) # pos+pad+neg+pad
+			return RerankModel.Dataset._attach_ranker_outputs(self, feed_dict, predict_dict['prediction'], predict_dict['u_v'], predict_dict['i_v'])
+
 class RerankSeqModel(RerankModel):
 	reader='ImpressionSeqReader'
 	runner='ImpressionRunner'
@@ -106,28 +184,36 @@ class RerankSeqModel(RerankModel):
 		super().__init__(args, corpus)
 		self.history_max = args.history_max
 	
-	class Dataset(ImpressionSeqModel.Dataset):		
+	class Dataset(ImpressionSeqModel.Dataset):
+		def __getitem__(self, index: int) -> dict:
+			return RerankModel.Dataset.__getitem__(self, index)
+
+		def prepare(self):
+			super().prepare()
+			if self.model.cache_ranker:
+				his_len = max(self.data['position']) if len(self) else 1
+				if self.model.history_max > 0:
+					his_len = min(his_len, self.model.history_max)
+				RerankModel.Dataset._load_ranker_cache(self, ImpressionSeqModel.Dataset.collate_batch, his_len)
+
+		def _ranker_history_vectors(self, history_items):
+			#modeling user history, need all history item vector
+			ranker = self.model.ranker
+			if 'LightGCN' in self.model.ranker_name:
+				return ranker.encoder.embedding_dict['item_emb'][history_items.to(self.model.device),:]
+			return ranker.i_embeddings(history_items.to(self.model.device))
+
 		# Collate a batch according to the list of feed dicts
 		def collate_batch(self, feed_dicts: List[dict]) -> dict: # feed_dicts are a batch of dicts
 			feed_dict = super().collate_batch(feed_dicts)
 			feed_dict['batch_size'] = len(feed_dicts)
+			if self.model.cache_ranker:
+				cached = RerankModel.Dataset._cached_ranker_outputs(self, feed_dict)
+				utils.batch_to_gpu(feed_dict, self.model.device)
+				feed_dict = RerankModel.Dataset._attach_ranker_outputs(self, feed_dict, cached['scores'], cached['u_v'], cached['i_v'])
+				feed_dict['his_v'] = cached['his_v'][:, :feed_dict['history_items'].shape[1]]
+				return feed_dict
 			predict_dict = self.model.ranker(utils.batch_to_gpu(feed_dict, self.model.device)) # pos+pad+neg+pad
-			feed_dict['scores'] = predict_dict['prediction'] # [batch(or num_sequence),n_candidate]
-			pos_mask = torch.arange(0, self.model.train_max_pos_item, device = self.model.device).type_as(feed_dict['pos_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_pos_item).lt(feed_dict['pos_num'].unsqueeze(1))
-			neg_mask = torch.arange(0, self.model.train_max_neg_item, device = self.model.device).type_as(feed_dict['neg_num']).unsqueeze(0).expand(feed_dict['batch_size'], self.model.train_max_neg_item).lt(feed_dict['neg_num'].unsqueeze(1))
-			all_mask = torch.cat([pos_mask, neg_mask],dim = 1)
-			feed_dict['padding_mask'] = ~all_mask
-			feed_dict['scores'] = torch.where(all_mask == 1, feed_dict['scores'],-np.inf * torch.ones_like(feed_dict['scores']))
-			_,temp = feed_dict['scores'].sort(dim = 1, descending = True)
-			_,feed_dict['position'] = temp.sort(dim = 1)
-			feed_dict['u_v'] = predict_dict['u_v'] # [batch(or num_sequence),ranker_embedding_len]
-			feed_dict['i_v'] = predict_dict['i_v'] # [batch(or num_sequence),ranker_embedding_len]
-
-			#modeling user history, need all history item vector
-			ranker = self.model.ranker
-			if 'LightGCN' in self.model.ranker_name:
-				all_his_its = ranker.encoder.embedding_dict['item_emb'][feed_dict['history_items'].to(self.model.device),:]
-			else:
-				all_his_its = ranker.i_embeddings(feed_dict['history_items'].to(self.model.device))
-			feed_dict['his_v']=all_his_its
-			return feed_dict
\ No newline at end of file
+			feed_dict = RerankModel.Dataset._attach_ranker_outputs(self, feed_dict, predict_dict['prediction'], predict_dict['u_v'], predict_dict['i_v'])
+			feed_dict['his_v'] = RerankSeqModel.Dataset._ranker_history_vectors(self, feed_dict['history_items'])
+			return feed_dict
@@ -31,12 +31,17 @@ class BPRMFBase(object):
 		self.u_embeddings = nn.Embedding(self.user_num, self.emb_size)
 		self.i_embeddings = nn.Embedding(self.item_num, self.emb_size)
 
+	def user_representation(self, feed_dict):
+		return self.u_embeddings(feed_dict['user_id'])  # [batch_size, emb_size]
+
+	def item_representations(self):
+		return self.i_embeddings.weight  # [n_items, emb_size]
+
 	def forward(self, feed_dict):
 		self.check_list = []
-		u_ids = feed_dict['user_id']  # [batch_size]
 		i_ids = feed_dict['item_id']  # [batch_size, -1]
 
-		cf_u_vectors = self.u_embeddings(u_ids)
+		cf_u_vectors = self.user_representation(feed_dict)
 		cf_i_vectors = self.i_embeddings(i_ids)
 
 		prediction = (cf_u_vectors[:, None, :] * cf_i_vectors).sum(dim=-1)  # [batch_size, -1]
@@ -48,6 +53,7 @@ class BPRMF(GeneralModel, BPRMFBase):
 	reader = 'BaseReader'
 	runner = 'BaseRunner'
 	extra_log_args = ['emb_size', 'batch_size']
+	sparse_embeddings = ['u_embeddings', 'i_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -66,6 +72,7 @@ class BPRMFImpression(ImpressionModel, BPRMFBase):
 	reader = 'ImpressionReader'
 	runner = 'ImpressionRunner'
 	extra_log_args = ['emb_size', 'batch_size']
+	sparse_embeddings = ['u_embeddings', 'i_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -21,6 +21,7 @@ import numpy as np
 import pandas as pd
 
 from utils import utils
+from utils import sampling
 from models.BaseModel import GeneralModel
 from helpers.KGReader import KGReader
 
@@ -100,7 +101,7 @@ class CFKG(GeneralModel):
             else:
                 target_item = self.data['item_id'][index]
                 if self.model.test_all:
-                    neg_items = np.arange(1, self.corpus.n_items)
+                    neg_items = np.array([], dtype=int)  # the catalog is appended per batch in collate_batch
                 else:
                     neg_items = self.data['neg_items'][index]
                 tail_id = np.concatenate([[target_item], neg_items])
@@ -111,19 +112,40 @@ class CFKG(GeneralModel):
             feed_dict = {'head_id': head_id, 'tail_id': tail_id, 'relation_id': relation_id}
             return feed_dict
 
+        def _append_catalog(self, feed_dict):
+            tail_id = feed_dict['tail_id']
+            catalog = torch.arange(1, self.corpus.n_items, dtype=tail_id.dtype) + self.corpus.n_users
+            feed_dict['tail_id'] = torch.cat([tail_id[:, :1], catalog.expand(tail_id.shape[0], -1)], dim=1)
+            feed_dict['head_id'] = feed_dict['head_id'][:, :1].expand_as(feed_dict['tail_id'])
+            feed_dict['relation_id'] = torch.zeros_like(feed_dict['tail_id'])
+            return feed_dict
+
         def actions_before_epoch(self):
-            for i in range(len(self)):
-                head, tail, relation = self.data['head'][i], self.data['tail'][i], self.data['relation'][i]
-                self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                if relation == 0:  # "buy" relation
-                    self.neg_heads[i] = np.random.randint(1, self.corpus.n_users)
-                    while self.neg_tails[i] in self.corpus.train_clicked_set[head]:
-                        self.neg_tails[i] = np.random.randint(1, self.corpus.n_items)
-                    while tail in self.corpus.train_clicked_set[self.neg_heads[i]]:
-                        self.neg_heads[i] = np.random.randint(1, self.corpus.n_users)
-                else:
-                    self.neg_heads[i] = np.random.randint(1, self.corpus.n_entities)
-                    while (head, relation, self.neg_tails[i]) in self.corpus.triplet_set:
-                        self.neg_tails[i] = np.random.randint(1, self.corpus.n_entities)
-                    while (self.neg_heads[i], relation, tail) in self.corpus.triplet_set:
-                        self.neg_heads[i] = np.random.randint(1, self.corpus.n_entities)
+            if not hasattr(self, 'clicked_index'):
+                self.clicked_index = sampling.CSRIndex(
+                    self.corpus.train_clicked_set, self.corpus.n_users, self.corpus.n_items)
+                self.triplet_index = sampling.TripletIndex(
+                    self.corpus.triplet_set, self.corpus.n_relations, self.corpus.n_entities)
+            heads, tails, relations = self.data['head'], self.data['tail'], self.data['relation']
+            neg_heads, neg_tails = np.zeros(len(self), dtype=int), np.zeros(len(self), dtype=int)
+
+            # "buy" relation: corrupt with items not clicked by the user / users who have not clicked the item
+            buy = np.nonzero(relations == 0)[0]
+            u, i = heads[buy], tails[buy]
+            neg_tails[buy] = sampling.reject_sample(
+                u, 1, sampling.uniform_draw(1, self.corpus.n_items), self.clicked_index.contains)[:, 0]
+            neg_heads[buy] = sampling.reject_sample(
+                i, 1, sampling.uniform_draw(1, self.corpus.n_users),
+                lambda items, users: self.clicked_index.contains(users, items))[:, 0]
+
+            # other relations: corrupt with entities not forming a known triplet
+            kg = np.nonzero(relations > 0)[0]
+            h, r, t = heads[kg], relations[kg], tails[kg]
+            rows = np.arange(len(kg))
+            neg_tails[kg] = sampling.reject_sample(
+                rows, 1, sampling.uniform_draw(1, self.corpus.n_entities),
+                lambda idx, x: self.triplet_index.contains(h[idx], r[idx], x))[:, 0]
+            neg_heads[kg] = sampling.reject_sample(
+                rows, 1, sampling.uniform_draw(1, self.corpus.n_entities),
+                lambda idx, x: self.triplet_index.contains(x, r[idx], t[idx]))[:, 0]
+            self.neg_heads, self.neg_tails = neg_heads, neg_tails
@@ -62,6 +62,12 @@ class LightGCNBase(object):
 	def _base_define_params(self):	
 		self.encoder = LGCNEncoder(self.user_num, self.item_num, self.emb_size, self.norm_adj, self.n_layers)
 
+	def user_representation(self, feed_dict):
+		return self.encoder.propagate()[0][feed_dict['user_id']]  # [batch_size, emb_size]
+
+	def item_representations(self):
+		return self.encoder.propagate()[1]  # [n_items, emb_size]
+
 	def forward(self, feed_dict):
 		self.check_list = []
 		user, items = feed_dict['user_id'], feed_dict['item_id']
@@ -118,6 +124,7 @@ class LGCNEncoder(nn.Module):
 
 		self.embedding_dict = self._init_model()
 		self.sparse_norm_adj = self._convert_sp_mat_to_sp_tensor(self.norm_adj).cuda()
+		self.propagated = None  # propagated embeddings memoized in eval mode
 
 	def _init_model(self):
 		initializer = nn.init.xavier_uniform_
@@ -134,7 +141,17 @@ class LGCNEncoder(nn.Module):
 		v = torch.from_numpy(coo.data).float()
 		return torch.sparse.FloatTensor(i, v, coo.shape)
 
-	def forward(self, users, items):
+	def train(self, mode=True):
+		self.propagated = None  # weights may change (training) or have changed (eval after training)
+		return super().train(mode)
+
+	def propagate(self):
+		"""
+		Propagated once per evaluation: the tables are memoized in eval mode and cleared on train()/eval().
+		:return: the propagated embeddings of all users [n_users, emb_size] and all items [n_items, emb_size]
+		"""
+		if not self.training and self.propagated is not None:
+			return self.propagated
 		ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
 		all_embeddings = [ego_embeddings]
 
@@ -147,7 +164,12 @@ class LGCNEncoder(nn.Module):
 
 		user_all_embeddings = all_embeddings[:self.user_count, :]
 		item_all_embeddings = all_embeddings[self.user_count:, :]
+		if not self.training:
+			self.propagated = (user_all_embeddings, item_all_embeddings)
+		return user_all_embeddings, item_all_embeddings
 
+	def forward(self, users, items):
+		user_all_embeddings, item_all_embeddings = self.propagate()
 		user_embeddings = user_all_embeddings[users, :]
 		item_embeddings = item_all_embeddings[items, :]
 
@@ -14,6 +14,7 @@ class MF(GeneralModel):
     reader = 'BaseReader'
     runner = 'BaseRunner'
     extra_log_args = ['emb_size', 'batch_size']
+    sparse_embeddings = ['user_emb', 'item_emb']
 
     @staticmethod
     def parse_model_args(parser):
@@ -38,16 +39,21 @@ class MF(GeneralModel):
         nn.init.xavier_uniform_(self.user_emb.weight)
         nn.init.xavier_uniform_(self.item_emb.weight)
 
+    def user_representation(self, feed_dict):
+        return self.user_emb(feed_dict['user_id'])  # [B, d]
+
+    def item_representations(self):
+        return self.item_emb.weight                 # [n_items, d]
+
     def forward(self, feed_dict):
         """
         feed_dict:
             user_id: [batch_size]
             item_id: [batch_size, n_candidates]
         """
-        user = feed_dict['user_id']
         items = feed_dict['item_id']
 
-        u_emb = self.user_emb(user)                 # [B, d]
+        u_emb = self.user_representation(feed_dict) # [B, d]
         i_emb = self.item_emb(items)                # [B, K, d]
 
         # 内积
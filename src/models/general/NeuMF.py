@@ -23,6 +23,7 @@ class NeuMF(GeneralModel):
     reader = 'BaseReader'
     runner = 'BaseRunner'
     extra_log_args = ['emb_size', 'layers']
+    sparse_embeddings = ['mf_u_embeddings', 'mf_i_embeddings', 'mlp_u_embeddings', 'mlp_i_embeddings']
 
     @staticmethod
     def parse_model_args(parser):
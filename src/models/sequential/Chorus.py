@@ -196,6 +196,8 @@ class Chorus(SequentialModel):
             return super().customize_parameters()
 
     class Dataset(SequentialModel.Dataset):
+        catalog_per_row = True  # time intervals of each candidate w.r.t. the history of the row
+
         def __init__(self, model, corpus, phase):
             super().__init__(model, corpus, phase)
             self.kg_train = self.model.stage == 1 and self.phase == 'train'
@@ -23,6 +23,7 @@ class ComiRec(SequentialModel):
     reader = 'SeqReader'
     runner = 'BaseRunner'
     extra_log_args = ['emb_size', 'attn_size', 'K']
+    shuffle_candidates = True  # the interest is selected with the first candidate during training
 
     @staticmethod
     def parse_model_args(parser):
@@ -59,7 +59,7 @@ class FPMC(SequentialModel):
         def _get_feed_dict(self, index):
             user_id, target_item = self.data['user_id'][index], self.data['item_id'][index]
             if self.phase != 'train' and self.model.test_all:
-                neg_items = np.arange(1, self.corpus.n_items)
+                neg_items = np.array([], dtype=int)  # the catalog is appended per batch in collate_batch
             else:
                 neg_items = self.data['neg_items'][index]
             item_ids = np.concatenate([[target_item], neg_items]).astype(int)
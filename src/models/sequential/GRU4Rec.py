@@ -38,9 +38,7 @@ class GRU4RecBase(object):
 		# self.pred_embeddings = nn.Embedding(self.item_num, self.hidden_size)
 		self.out = nn.Linear(self.hidden_size, self.emb_size)
 
-	def forward(self, feed_dict):
-		self.check_list = []
-		i_ids = feed_dict['item_id']  # [batch_size, -1]
+	def user_representation(self, feed_dict):
 		history = feed_dict['history_items']  # [batch_size, history_max]
 		lengths = feed_dict['lengths']  # [batch_size]
 
@@ -58,11 +56,19 @@ class GRU4RecBase(object):
 		# Unsort
 		unsort_idx = torch.topk(sort_idx, k=len(lengths), largest=False)[1]
 		rnn_vector = hidden[-1].index_select(dim=0, index=unsort_idx)
+		return self.out(rnn_vector)  # [batch_size, emb_size]
+
+	def item_representations(self):
+		return self.i_embeddings.weight  # [n_items, emb_size]
+
+	def forward(self, feed_dict):
+		self.check_list = []
+		i_ids = feed_dict['item_id']  # [batch_size, -1]
+		rnn_vector = self.user_representation(feed_dict)
 
 		# Predicts
 		# pred_vectors = self.pred_embeddings(i_ids)
 		pred_vectors = self.i_embeddings(i_ids)
-		rnn_vector = self.out(rnn_vector)
 		prediction = (rnn_vector[:, None, :] * pred_vectors).sum(-1)
 		
 		u_v = rnn_vector.repeat(1,i_ids.shape[1]).view(i_ids.shape[0],i_ids.shape[1],-1)
@@ -75,6 +81,7 @@ class GRU4Rec(SequentialModel, GRU4RecBase):
 	reader = 'SeqReader'
 	runner = 'BaseRunner'
 	extra_log_args = ['emb_size', 'hidden_size']
+	sparse_embeddings = ['i_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -93,6 +100,7 @@ class GRU4RecImpression(ImpressionSeqModel, GRU4RecBase):
 	reader = 'ImpressionSeqReader'
 	runner = 'ImpressionRunner'
 	extra_log_args = ['emb_size', 'hidden_size']
+	sparse_embeddings = ['i_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
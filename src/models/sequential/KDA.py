@@ -218,6 +218,15 @@ class KDA(SequentialModel):
                 feed_dict['value_id'] = self.kg_data['value'][index]
             return feed_dict
 
+        def _append_catalog(self, feed_dict):
+            feed_dict = super()._append_catalog(feed_dict)
+            if not hasattr(self, 'catalog_val'):
+                self.catalog_val = torch.tensor([self.item_val_dict[item] for item in range(1, self.corpus.n_items)])
+            item_val = feed_dict['item_val']
+            catalog_val = self.catalog_val.to(item_val.dtype).expand(item_val.shape[0], -1, -1)
+            feed_dict['item_val'] = torch.cat([item_val[:, :1], catalog_val], dim=1)
+            return feed_dict
+
         def generate_kg_data(self) -> pd.DataFrame:
             rec_data_size = len(self)
             replace = (rec_data_size > len(self.corpus.relation_df))
@@ -48,9 +48,7 @@ class SASRecBase(object):
 			for _ in range(self.num_layers)
 		])
 
-	def forward(self, feed_dict):
-		self.check_list = []
-		i_ids = feed_dict['item_id']  # [batch_size, -1]
+	def user_representation(self, feed_dict):
 		history = feed_dict['history_items']  # [batch_size, history_max]
 		lengths = feed_dict['lengths']  # [batch_size]
 		batch_size, seq_len = history.shape
@@ -76,6 +74,16 @@ class SASRecBase(object):
 		his_vector = his_vectors[torch.arange(batch_size), lengths - 1, :]
 		# his_vector = his_vectors.sum(1) / lengths[:, None].float()
 		# ↑ average pooling is shown to be more effective than the most recent embedding
+		return his_vector  # [batch_size, emb_size]
+
+	def item_representations(self):
+		return self.i_embeddings.weight  # [n_items, emb_size]
+
+	def forward(self, feed_dict):
+		self.check_list = []
+		i_ids = feed_dict['item_id']  # [batch_size, -1]
+		batch_size = i_ids.shape[0]
+		his_vector = self.user_representation(feed_dict)
 
 		i_vectors = self.i_embeddings(i_ids)
 		prediction = (his_vector[:, None, :] * i_vectors).sum(-1)
@@ -90,6 +98,7 @@ class SASRec(SequentialModel, SASRecBase):
 	reader = 'SeqReader'
 	runner = 'BaseRunner'
 	extra_log_args = ['emb_size', 'num_layers', 'num_heads']
+	sparse_embeddings = ['i_embeddings', 'p_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
@@ -108,6 +117,7 @@ class SASRecImpression(ImpressionSeqModel, SASRecBase):
 	reader = 'ImpressionSeqReader'
 	runner = 'ImpressionRunner'
 	extra_log_args = ['emb_size', 'num_layers', 'num_heads']
+	sparse_embeddings = ['i_embeddings', 'p_embeddings']
 
 	@staticmethod
 	def parse_model_args(parser):
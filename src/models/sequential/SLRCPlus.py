@@ -89,6 +89,8 @@ class SLRCPlus(SequentialModel):
         return {'prediction': prediction.view(feed_dict['batch_size'], -1)}
 
     class Dataset(SequentialModel.Dataset):
+        catalog_per_row = True  # time intervals of each candidate w.r.t. the history of the row
+
         def _get_feed_dict(self, index):
             feed_dict = super()._get_feed_dict(index)
             user_id, time = self.data['user_id'][index], self.data['time'][index]
@@ -30,6 +30,7 @@ class TiMiRec(SequentialModel):
     reader = 'SeqReader'
     runner = 'BaseRunner'
     extra_log_args = ['emb_size', 'attn_size', 'K', 'temp', 'add_pos', 'add_trm', 'n_layers']
+    shuffle_candidates = True  # the interest is selected with the first candidate during training
 
     @staticmethod
     def parse_model_args(parser):
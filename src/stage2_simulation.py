@@ -3,7 +3,7 @@ import os
 import sys
 import io
 import json
-import re
+import numpy as np
 import pandas as pd
 from openai import OpenAI
 from tqdm import tqdm
@@ -19,7 +19,7 @@ MY_BASE_URL = "https://api.siliconflow.cn/v1/"
 MODEL_NAME = "deepseek-ai/DeepSeek-V3.2"
 
 PROFILES_PATH = "agent_profiles.json"
-CANDIDATES_PATH = "../log/LightGCN/LightGCN__Grocery_Subset__0__lr=0/rec-LightGCN-test.csv" 
+CANDIDATES_PATH = "../log/LightGCN/LightGCN__Grocery_Subset__0__lr=0/rec-LightGCN-test.npz" 
 META_PATH = "../data/Grocery_Subset/item_meta_enriched.csv"
 FEEDBACK_LOG_PATH = "../data/Grocery_Subset/agent_feedback.csv"
 
@@ -31,10 +31,9 @@ client = OpenAI(api_key=MY_API_KEY, base_url=MY_BASE_URL)
 # ===================== 🛠️ 辅助加载函数 =====================
 
 def load_candidates():
-    df = pd.read_csv(CANDIDATES_PATH, sep="\t")
-    def parse_ids(s):
-        return [int(x) for x in re.findall(r'\d+', str(s))]
-    return df.set_index('user_id')['rec_items'].apply(parse_ids).to_dict()
+    # main.py 导出的 npz: user_id (n,), rec_items (n, topk)
+    with np.load(CANDIDATES_PATH) as rec:
+        return dict(zip(rec['user_id'].tolist(), rec['rec_items'].tolist()))
 
 def load_meta():
     meta = pd.read_csv(META_PATH, sep="\t", encoding='utf-8')
@@ -0,0 +1,69 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import copy
+import torch
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import utils
+
+
+def to_cpu(obj):
+	"""
+	Copy all tensors in a (nested) state to CPU memory, so that it stays unchanged while training goes on.
+	"""
+	if isinstance(obj, torch.Tensor):
+		return obj.detach().to('cpu', copy=True)
+	if isinstance(obj, dict):
+		return {k: to_cpu(v) for k, v in obj.items()}
+	if isinstance(obj, (list, tuple)):
+		return type(obj)(to_cpu(v) for v in obj)
+	return copy.deepcopy(obj)
+
+
+def get_rng_state() -> dict:
+	state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+	if torch.cuda.is_available():
+		state['cuda'] = torch.cuda.get_rng_state_all()
+	return state
+
+
+def set_rng_state(state: dict):
+	random.setstate(state['random'])
+	np.random.set_state(state['numpy'])
+	torch.set_rng_state(state['torch'])
+	if 'cuda' in state and torch.cuda.is_available():
+		torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer(object):
+	"""
+	Save checkpoints in a background thread: the state is first copied to CPU memory and the copy is written
+	in order of submission, each file being replaced atomically (a crash never leaves a half-written checkpoint).
+	"""
+	def __init__(self):
+		self.executor = ThreadPoolExecutor(max_workers=1)
+		self.futures = list()
+
+	@staticmethod
+	def _write(state, path: str):
+		utils.check_dir(path)
+		torch.save(state, path + '.tmp')
+		os.replace(path + '.tmp', path)
+
+	def save(self, state, path: str):
+		"""
+		:return: the CPU snapshot being written
+		"""
+		snapshot = to_cpu(state)
+		self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+		self.futures.append(self.executor.submit(self._write, snapshot, path))
+		return snapshot
+
+	def wait(self):
+		# block until all submitted checkpoints are on disk, raising the first failure
+		futures, self.futures = self.futures, list()
+		for future in futures:
+			future.result()
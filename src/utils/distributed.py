@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+
+import torch
+import numpy as np
+import torch.distributed as dist
+
+from utils import utils
+
+
+def shard_dataset(dataset, rank: int, world_size: int):
+	"""
+	Keep every world_size-th row of a training dataset, starting from rank, so that each worker samples
+	and trains on its own shard. Shards are padded with rows from the beginning to the same length, so that
+	all workers run the same number of steps. Row-aligned caches (e.g., the ranker cache of rerankers) are sliced alike.
+	"""
+	n = len(dataset)
+	rows = (np.arange(-(-n // world_size) * world_size) % n)[rank::world_size]
+	shard = utils.select_rows(dataset, rows)
+	dataset.data = shard.data
+	if getattr(dataset, 'ranker_cache', None) is not None:
+		dataset.ranker_cache = shard.ranker_cache
+
+
+def _all_reduce_sparse(grad: torch.Tensor, world_size: int) -> torch.Tensor:
+	# gloo cannot all-reduce sparse tensors: gather the (padded) rows of every worker and merge them
+	grad = grad.coalesce()
+	indices, values = grad.indices(), grad.values()
+	size = torch.tensor([indices.shape[1]], dtype=torch.long)
+	sizes = [torch.zeros_like(size) for _ in range(world_size)]
+	dist.all_gather(sizes, size)
+	max_size = max(s.item() for s in sizes)
+	pad_indices = indices.new_zeros((indices.shape[0], max_size))
+	pad_values = values.new_zeros((max_size,) + values.shape[1:])
+	pad_indices[:, :len(values)], pad_values[:len(values)] = indices, values
+	all_indices = [torch.zeros_like(pad_indices) for _ in range(world_size)]
+	all_values = [torch.zeros_like(pad_values) for _ in range(world_size)]
+	dist.all_gather(all_indices, pad_indices)
+	dist.all_gather(all_values, pad_values)
+	indices = torch.cat([x[:, :s.item()] for x, s in zip(all_indices, sizes)], dim=1)
+	values = torch.cat([x[:s.item()] for x, s in zip(all_values, sizes)], dim=0)
+	return torch.sparse_coo_tensor(indices, values / world_size, grad.shape).coalesce()
+
+
+def all_reduce_gradients(model: torch.nn.Module, world_size: int):
+	"""
+	Average the gradients of all workers in place. Dense gradients are reduced in one flattened buffer,
+	sparse (embedding) gradients are gathered row-wise. A parameter without gradient on some worker
+	takes zeros there, so that all workers issue the same collectives.
+	"""
+	params = [p for p in model.parameters() if p.requires_grad]
+	has_grad = torch.tensor([p.grad is not None for p in params], dtype=torch.float)
+	dist.all_reduce(has_grad)
+	sparse_ids = set(id(getattr(model, name).weight) for name in model.sparse_embeddings
+					 if getattr(model, name).sparse)
+	dense, sparse = list(), list()
+	for p, flag in zip(params, has_grad.tolist()):
+		if flag == 0:
+			continue
+		if p.grad is None and id(p) in sparse_ids:
+			p.grad = torch.sparse_coo_tensor(torch.zeros((1, 0), dtype=torch.long), p.new_zeros((0,) + p.shape[1:]), p.shape)
+		elif p.grad is None:
+			p.grad = torch.zeros_like(p)
+		(sparse if p.grad.is_sparse else dense).append(p)
+	if len(dense):
+		flat = torch.cat([p.grad.reshape(-1) for p in dense])
+		dist.all_reduce(flat)
+		flat /= world_size
+		offset = 0
+		for p in dense:
+			p.grad.copy_(flat[offset:offset + p.numel()].view_as(p.grad))
+			offset += p.numel()
+	for p in sparse:
+		p.grad = _all_reduce_sparse(p.grad, world_size)
+
+
+def all_reduce_mean(value: float, world_size: int) -> float:
+	tensor = torch.tensor([value], dtype=torch.float64)
+	dist.all_reduce(tensor)
+	return tensor.item() / world_size
+
+
+def broadcast_flag(flag: bool) -> bool:
+	# share a decision of rank 0 (e.g., early stop) with all workers
+	tensor = torch.tensor([int(flag)])
+	dist.broadcast(tensor, 0)
+	return bool(tensor.item())
+
+
+def merge_shards(parts: list) -> dict:
+	"""
+	Concatenate the arrays predicted on consecutive row shards. Score matrices of different widths
+	(e.g., fewer candidates in some shard) are padded with -inf, like BaseRunner.predict.
+	"""
+	merged = dict()
+	for name in parts[0]:
+		arrays = [part[name] for part in parts]
+		if arrays[0].ndim == 2 and len(set(a.shape[1] for a in arrays)) > 1:
+			width = max(a.shape[1] for a in arrays)
+			arrays = [np.pad(a, ((0, 0), (0, width - a.shape[1])), constant_values=-np.inf) for a in arrays]
+		merged[name] = np.concatenate(arrays)
+	return merged
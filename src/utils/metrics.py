@@ -0,0 +1,183 @@
+# -*- coding: UTF-8 -*-
+
+import torch
+import numpy as np
+from typing import Dict
+
+RANK_METRICS = ['HR', 'NDCG', 'MRR', 'RECALL']
+CTR_METRICS = ['ACC', 'AUC', 'GAUC', 'F1_SCORE', 'LOG_LOSS']
+
+
+def rank_metric_rows(gt_rank: np.ndarray, topk: list, metrics: list) -> Dict[str, np.ndarray]:
+	"""
+	Per-row ranking metrics of rows with one ground-truth item, their means are the reported results.
+	:param gt_rank: (-1,) shape, the rank of the ground-truth item among the candidates of each row (from 1)
+	:return: a dict of (-1,) arrays, the keys are metric@topk
+	"""
+	gt_rank = np.asarray(gt_rank)
+	rows = dict()
+	for k in topk:
+		hit = (gt_rank <= k)
+		for metric in metrics:
+			key = '{}@{}'.format(metric, k)
+			if metric in ['HR', 'RECALL']:  # a single ground-truth item per row
+				rows[key] = hit.astype(np.float64)
+			elif metric == 'NDCG':
+				rows[key] = hit / np.log2(gt_rank + 1)
+			elif metric == 'MRR':
+				rows[key] = hit / gt_rank
+			else:
+				raise ValueError('Undefined evaluation metric: {}.'.format(metric))
+	return rows
+
+
+def ctr_metric_rows(predictions: np.ndarray, labels: np.ndarray, metrics: list) -> Dict[str, np.ndarray]:
+	"""
+	Per-row CTR metrics. Only ACC and LOG_LOSS are means over rows, the other metrics are skipped.
+	"""
+	predictions, labels = np.asarray(predictions, dtype=np.float64), np.asarray(labels, dtype=np.float64)
+	rows = dict()
+	for metric in metrics:
+		if metric == 'ACC':
+			rows[metric] = ((predictions > 0.5) == labels).astype(np.float64)
+		elif metric == 'LOG_LOSS':
+			clipped = np.clip(predictions, 1e-7, 1 - 1e-7)
+			rows[metric] = -(np.log(clipped) * labels + np.log(1 - clipped) * (1 - labels))
+	return rows
+
+
+class RankAccumulator(object):
+	"""
+	Running sums of ranking metrics over rows with one ground-truth item, updated batch by batch on the
+	device of the ranks, so that only the aggregates leave the device. With one relevant item per row,
+	Recall@k equals HR@k and MRR@k is the reciprocal rank of hits within the top k.
+	"""
+	def __init__(self, topk: list, metrics: list):
+		for metric in metrics:
+			if metric not in RANK_METRICS:
+				raise ValueError('Undefined evaluation metric: {}.'.format(metric))
+		self.topk, self.metrics = topk, metrics
+		self.sums, self.count = None, 0
+
+	def update(self, gt_rank: torch.Tensor):
+		"""
+		:param gt_rank: [batch_size] rank of the ground-truth item among the candidates of each row (from 1)
+		"""
+		gt_rank = gt_rank.double()
+		if self.sums is None:
+			self.sums = torch.zeros((len(self.topk), len(self.metrics)), dtype=torch.float64, device=gt_rank.device)
+		for i, k in enumerate(self.topk):
+			hit = (gt_rank <= k).double()
+			for j, metric in enumerate(self.metrics):
+				if metric in ['HR', 'RECALL']:
+					self.sums[i, j] += hit.sum()
+				elif metric == 'NDCG':
+					self.sums[i, j] += (hit / torch.log2(gt_rank + 1)).sum()
+				elif metric == 'MRR':
+					self.sums[i, j] += (hit / gt_rank).sum()
+		self.count += len(gt_rank)
+
+	def result(self) -> Dict[str, float]:
+		means = (self.sums / max(self.count, 1)).cpu().numpy() if self.sums is not None else None
+		evaluations = dict()
+		for i, k in enumerate(self.topk):
+			for j, metric in enumerate(self.metrics):
+				evaluations['{}@{}'.format(metric, k)] = means[i, j] if means is not None else 0.
+		return evaluations
+
+
+def group_auc(users: np.ndarray, scores: np.ndarray, labels: np.ndarray) -> float:
+	"""
+	Exact GAUC: the AUC of each user (Mann-Whitney rank sums, ties get average ranks), averaged with the number of
+	impressions of the user as weight. Users with only positive or only negative labels are skipped.
+	"""
+	order = np.lexsort((scores, users))
+	users, scores, labels = users[order], scores[order], labels[order].astype(np.float64)
+	n = len(users)
+	if n == 0:
+		return 0.
+	user_start = np.r_[True, users[1:] != users[:-1]]
+	tie_start = user_start | np.r_[True, scores[1:] != scores[:-1]]
+	positions = np.arange(n)
+	ranks = positions - np.maximum.accumulate(np.where(user_start, positions, 0)) + 1  # rank within the user
+	tie_id = np.cumsum(tie_start) - 1
+	ranks = (np.bincount(tie_id, weights=ranks) / np.bincount(tie_id))[tie_id]
+	user_idx = np.cumsum(user_start) - 1
+	n_pos = np.bincount(user_idx, weights=labels)
+	n_neg = np.bincount(user_idx) - n_pos
+	rank_sum = np.bincount(user_idx, weights=ranks * labels)
+	valid = (n_pos > 0) & (n_neg > 0)
+	if not valid.any():
+		return 0.
+	auc = (rank_sum[valid] - n_pos[valid] * (n_pos[valid] + 1) / 2) / (n_pos[valid] * n_neg[valid])
+	weights = n_pos[valid] + n_neg[valid]
+	return (auc * weights).sum() / weights.sum()
+
+
+class CTRAccumulator(object):
+	"""
+	Streaming CTR metrics updated batch by batch: ACC, F1_SCORE and LOG_LOSS from running counts and sums, and AUC
+	from histograms of positive/negative scores over n_bins equal-width bins of [0, 1]. Pairs falling into the same
+	bin count as ties, so the AUC error is at most sum_b(pos_b * neg_b) / (2 * n_pos * n_neg) (see auc_error_bound).
+	GAUC is exact: only (user, score, label) of every row is kept, in compact columnar buffers.
+	"""
+	def __init__(self, metrics: list, n_bins: int = 65536):
+		for metric in metrics:
+			if metric not in CTR_METRICS:
+				raise ValueError('Undefined evaluation metric: {}.'.format(metric))
+		self.metrics, self.n_bins = metrics, n_bins
+		self.sums = None  # correct, tp, fp, fn, log_loss
+		self.pos_hist, self.neg_hist = None, None
+		self.users, self.scores, self.labels = list(), list(), list()
+		self.count = 0
+
+	def update(self, predictions: torch.Tensor, labels: torch.Tensor, users: torch.Tensor = None):
+		predictions, labels = predictions.detach().double().flatten(), labels.detach().double().flatten()
+		if self.sums is None:
+			self.sums = torch.zeros(5, dtype=torch.float64, device=predictions.device)
+			self.pos_hist = torch.zeros(self.n_bins, dtype=torch.float64, device=predictions.device)
+			self.neg_hist = torch.zeros(self.n_bins, dtype=torch.float64, device=predictions.device)
+		hard = (predictions > 0.5).double()
+		clipped = predictions.clamp(1e-7, 1 - 1e-7)
+		self.sums += torch.stack([
+			(hard == labels).double().sum(), (hard * labels).sum(), (hard * (1 - labels)).sum(),
+			((1 - hard) * labels).sum(), -(clipped.log() * labels + (1 - clipped).log() * (1 - labels)).sum()])
+		bins = (predictions.clamp(0, 1) * self.n_bins).long().clamp(max=self.n_bins - 1)
+		self.pos_hist += torch.bincount(bins, weights=labels, minlength=self.n_bins)
+		self.neg_hist += torch.bincount(bins, weights=1 - labels, minlength=self.n_bins)
+		if 'GAUC' in self.metrics:
+			self.users.append(users.detach().flatten().cpu().numpy())
+			self.scores.append(predictions.float().cpu().numpy())
+			self.labels.append(labels.to(torch.int8).cpu().numpy())
+		self.count += len(predictions)
+
+	def _histogram_auc(self) -> float:
+		pos, neg = self.pos_hist, self.neg_hist
+		if self.sums is None or pos.sum() == 0 or neg.sum() == 0:
+			return 0.
+		neg_below = torch.cumsum(neg, dim=0) - neg  # negatives in lower bins
+		return (((pos * neg_below).sum() + 0.5 * (pos * neg).sum()) / (pos.sum() * neg.sum())).item()
+
+	def auc_error_bound(self) -> float:
+		pos, neg = self.pos_hist, self.neg_hist
+		if self.sums is None or pos.sum() == 0 or neg.sum() == 0:
+			return 0.
+		return (0.5 * (pos * neg).sum() / (pos.sum() * neg.sum())).item()
+
+	def result(self) -> Dict[str, float]:
+		correct, tp, fp, fn, log_loss = self.sums.tolist() if self.sums is not None else [0.] * 5
+		count = max(self.count, 1)
+		evaluations = dict()
+		for metric in self.metrics:
+			if metric == 'ACC':
+				evaluations[metric] = correct / count
+			elif metric == 'AUC':
+				evaluations[metric] = self._histogram_auc()
+			elif metric == 'F1_SCORE':
+				evaluations[metric] = 2 * tp / max(2 * tp + fp + fn, 1)
+			elif metric == 'LOG_LOSS':
+				evaluations[metric] = log_loss / count
+			elif metric == 'GAUC':
+				evaluations[metric] = group_auc(np.concatenate(self.users), np.concatenate(self.scores),
+												np.concatenate(self.labels)) if len(self.users) else 0.
+		return evaluations
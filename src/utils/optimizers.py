@@ -0,0 +1,66 @@
+# -*- coding: UTF-8 -*-
+
+import torch
+
+
+class RowWiseAdagrad(torch.optim.Optimizer):
+	"""
+	Adagrad with a single accumulator per embedding row (the mean squared gradient of the row),
+	updating only the rows present in a (sparse) gradient. The optimizer state is [n_rows] instead of [n_rows, dim].
+	"""
+	def __init__(self, params, lr=1e-2, eps=1e-10):
+		super().__init__(params, dict(lr=lr, eps=eps))
+		for group in self.param_groups:
+			for p in group['params']:
+				self.state[p]['sum'] = torch.zeros(p.shape[0], dtype=p.dtype, device=p.device)
+
+	@torch.no_grad()
+	def step(self, closure=None):
+		loss = None
+		if closure is not None:
+			with torch.enable_grad():
+				loss = closure()
+		for group in self.param_groups:
+			for p in group['params']:
+				if p.grad is None:
+					continue
+				if p.grad.is_sparse:
+					grad = p.grad.coalesce()
+					rows, values = grad.indices()[0], grad.values()
+				else:
+					rows = p.grad.abs().sum(dim=-1).nonzero().flatten()
+					values = p.grad[rows]
+				state_sum = self.state[p]['sum']
+				state_sum.index_add_(0, rows, values.pow(2).mean(dim=-1))
+				std = state_sum[rows].sqrt().add_(group['eps'])
+				p.index_add_(0, rows, values / std[:, None], alpha=-group['lr'])
+		return loss
+
+
+class CombinedOptimizer(object):
+	"""
+	Drive several optimizers (e.g., dense Adam and a sparse optimizer for embeddings) as one.
+	"""
+	def __init__(self, optimizers: list):
+		self.optimizers = optimizers
+
+	@property
+	def param_groups(self) -> list:
+		return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+	def zero_grad(self, set_to_none: bool = True):
+		for optimizer in self.optimizers:
+			optimizer.zero_grad(set_to_none=set_to_none)
+
+	def step(self, closure=None):
+		loss = None
+		for optimizer in self.optimizers:
+			loss = optimizer.step(closure)
+		return loss
+
+	def state_dict(self) -> dict:
+		return {'optimizers': [optimizer.state_dict() for optimizer in self.optimizers]}
+
+	def load_state_dict(self, state_dict: dict):
+		for optimizer, state in zip(self.optimizers, state_dict['optimizers']):
+			optimizer.load_state_dict(state)
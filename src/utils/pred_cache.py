@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import torch
+import pickle
+import shutil
+import hashlib
+import numpy as np
+from typing import Dict, Tuple, Union
+
+# attributes of a model that change along the run without changing its predictions
+VOLATILE_ATTRS = ['training', 'phase', 'compiled', 'model_path', 'optimizer']
+
+
+def _update_array(h, value):
+	if isinstance(value, torch.Tensor):
+		value = value.detach().cpu().numpy()
+	array = np.asarray(value) if not isinstance(value, np.ndarray) else value
+	if array.dtype == object:
+		h.update(pickle.dumps(value))
+	else:
+		h.update(str((array.dtype.str, array.shape)).encode())
+		h.update(np.ascontiguousarray(array).tobytes())
+
+
+def fingerprint(model: torch.nn.Module, dataset, *extra) -> str:
+	"""
+	Hash of what the predictions of a model on a dataset depend on: the weights (state_dict), the scalar arguments
+	and architecture of the model, the contents of the split, and any extra setting (e.g., precision).
+	"""
+	h = hashlib.sha1()
+	h.update(type(model).__name__.encode())
+	h.update(str(model).encode())
+	args = {k: v for k, v in vars(model).items()
+			if isinstance(v, (bool, int, float, str)) and k not in VOLATILE_ATTRS}
+	h.update(json.dumps(args, sort_keys=True).encode())
+	for name, tensor in model.state_dict().items():
+		h.update(name.encode())
+		_update_array(h, tensor)
+	h.update(str(dataset.phase).encode())
+	for key in sorted(dataset.data.keys()):
+		h.update(key.encode())
+		_update_array(h, dataset.data[key])
+	h.update(repr(extra).encode())
+	return h.hexdigest()
+
+
+def pack_predictions(predictions: Union[np.ndarray, dict, tuple]) -> Tuple[str, Dict[str, np.ndarray]]:
+	"""
+	Named arrays of a prediction: an array, a dict of arrays (e.g., predict_topk) or a tuple (e.g., CTR predictions and labels).
+	:return: the type of the prediction, and its arrays
+	"""
+	if isinstance(predictions, dict):
+		return 'dict', predictions
+	if isinstance(predictions, tuple):
+		return 'tuple', {str(i): x for i, x in enumerate(predictions)}
+	return 'array', {'prediction': predictions}
+
+
+def unpack_predictions(pred_type: str, arrays: Dict[str, np.ndarray]) -> Union[np.ndarray, dict, tuple]:
+	if pred_type == 'array':
+		return arrays['prediction']
+	if pred_type == 'tuple':
+		return tuple(arrays[str(i)] for i in range(len(arrays)))
+	return arrays
+
+
+class PredictionCache(object):
+	"""
+	Predictions saved on disk under the fingerprint of the model and split (one entry per kind of prediction,
+	e.g., full scores or top-k), one .npy file per array, loaded memory-mapped (read-only).
+	"""
+	def __init__(self, cache_dir: str):
+		self.cache_dir = cache_dir
+
+	def _load(self, path: str) -> Union[np.ndarray, dict, tuple, None]:
+		if not os.path.exists(os.path.join(path, 'meta.json')):
+			return None
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in meta['names']}
+		return unpack_predictions(meta['type'], arrays)
+
+	def get(self, key: str, kind: str = None) -> Union[np.ndarray, dict, tuple, None]:
+		"""
+		:param kind: kind of prediction, if None any cached kind is returned
+		"""
+		if kind is not None:
+			return self._load(os.path.join(self.cache_dir, key, kind))
+		if not os.path.isdir(os.path.join(self.cache_dir, key)):
+			return None
+		for kind in sorted(k for k in os.listdir(os.path.join(self.cache_dir, key)) if not k.endswith('.tmp')):
+			predictions = self._load(os.path.join(self.cache_dir, key, kind))
+			if predictions is not None:
+				return predictions
+		return None
+
+	def put(self, key: str, kind: str, predictions: Union[np.ndarray, dict, tuple]):
+		pred_type, arrays = pack_predictions(predictions)
+		meta = {'type': pred_type, 'names': list(arrays.keys())}
+		path = os.path.join(self.cache_dir, key, kind)
+		tmp_path = path + '.tmp'
+		shutil.rmtree(tmp_path, ignore_errors=True)
+		os.makedirs(tmp_path)
+		for name, array in arrays.items():
+			np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(array))
+		with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:  # written last: marks a complete entry
+			json.dump(meta, f)
+		shutil.rmtree(path, ignore_errors=True)
+		os.replace(tmp_path, path)
@@ -0,0 +1,85 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import traceback
+import numpy as np
+import multiprocessing as mp
+
+from utils import utils
+
+EXCLUDE_ATTRS = ['model', 'corpus', 'data', 'buffer_dict', 'phase']
+
+
+def sample_epoch_state(dataset) -> dict:
+	"""
+	Run actions_before_epoch and collect what it (re)assigned: data columns and dataset attributes
+	bound to new objects, plus numpy array attributes that may have been filled in place.
+	"""
+	attr_ids = {k: id(v) for k, v in vars(dataset).items()}
+	data_ids = {k: id(v) for k, v in dataset.data.items()} if type(dataset.data) == dict else dict()
+	dataset.actions_before_epoch()
+	attrs = {k: v for k, v in vars(dataset).items() if k not in EXCLUDE_ATTRS and
+			 (id(v) != attr_ids.get(k) or isinstance(v, np.ndarray))}
+	data = {k: v for k, v in dataset.data.items() if id(v) != data_ids.get(k)} \
+		if type(dataset.data) == dict else dataset.data
+	return {'attrs': attrs, 'data': data}
+
+
+def apply_epoch_state(dataset, state: dict):
+	if type(dataset.data) == dict:
+		dataset.data.update(state['data'])
+	else:
+		dataset.data = state['data']
+	for k, v in state['attrs'].items():
+		setattr(dataset, k, v)
+
+
+class EpochPrefetcher(object):
+	"""
+	Prepare the next epoch of a training dataset (negative sampling, etc.) in a forked background process
+	while the current epoch trains, and swap the result in between epochs.
+	Each preparation is seeded from the numpy stream of the main process, so that runs stay deterministic for
+	a given random seed. The state is sampled from a snapshot of the dataset (and model) at fork time.
+	"""
+	def __init__(self, dataset):
+		self.dataset = dataset
+		self.ctx = mp.get_context('fork')
+		self.process, self.conn = None, None
+
+	@staticmethod
+	def _run(dataset, seed, conn):
+		try:
+			utils.init_seed(seed)
+			conn.send(('ok', sample_epoch_state(dataset)))
+		except Exception:
+			conn.send(('error', traceback.format_exc()))
+		conn.close()
+
+	def _start(self):
+		seed = np.random.randint(2 ** 31 - 1)
+		self.conn, send_conn = self.ctx.Pipe(duplex=False)
+		self.process = self.ctx.Process(target=self._run, args=(self.dataset, seed, send_conn), daemon=True)
+		self.process.start()
+		send_conn.close()
+
+	def next_epoch(self):
+		"""
+		Swap in the prepared epoch (waiting for it if needed) and start preparing the following one.
+		"""
+		if self.process is None:
+			self._start()
+		status, state = self.conn.recv()
+		self.conn.close()
+		self.process.join()
+		if status != 'ok':
+			raise RuntimeError('Epoch preparation failed in the background process:\n' + state)
+		apply_epoch_state(self.dataset, state)
+		self._start()
+
+	def close(self):
+		if self.process is not None:
+			self.process.terminate()
+			self.process.join()
+			self.conn.close()
+			self.process, self.conn = None, None
+			logging.debug('Discard the prefetched epoch')
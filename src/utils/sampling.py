@@ -0,0 +1,284 @@
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+
+
+class CSRIndex(object):
+	"""
+	Sorted CSR index of (row, col) pairs, e.g., the clicked items of each user in the training set.
+	Every pair is encoded as a single key row * n_cols + col, so that membership of many pairs can be
+	checked at once with a binary search over the sorted keys.
+	"""
+	def __init__(self, row_sets: dict, n_rows: int, n_cols: int):
+		self.n_rows, self.n_cols = n_rows, n_cols
+		self.indptr = np.zeros(n_rows + 1, dtype=np.int64)
+		for row, cols in row_sets.items():
+			self.indptr[row + 1] = len(cols)
+		self.indptr = np.cumsum(self.indptr)
+		self.indices = np.zeros(self.indptr[-1], dtype=np.int64)
+		for row, cols in row_sets.items():
+			self.indices[self.indptr[row]:self.indptr[row + 1]] = np.sort(np.fromiter(cols, dtype=np.int64, count=len(cols)))
+		rows = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(self.indptr))
+		self.keys = rows * n_cols + self.indices  # globally sorted as rows ascend and cols are sorted within rows
+
+	def row(self, row: int) -> np.ndarray:
+		return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+	def pairs(self, rows: np.ndarray):
+		"""
+		:return: (positions, cols), all the cols of rows[i] paired with position i, as flat arrays
+		"""
+		rows = np.asarray(rows, dtype=np.int64)
+		starts, counts = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+		positions = np.repeat(np.arange(len(rows)), counts)
+		offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		return positions, self.indices[starts[positions] + offsets]
+
+	def contains(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+		"""
+		:param rows, cols: broadcastable integer arrays
+		:return: boolean array, True where (row, col) is in the index
+		"""
+		if len(self.keys) == 0:
+			return np.zeros(np.broadcast(rows, cols).shape, dtype=bool)
+		query = np.asarray(rows, dtype=np.int64) * self.n_cols + np.asarray(cols, dtype=np.int64)
+		pos = np.searchsorted(self.keys, query)
+		return self.keys[np.minimum(pos, len(self.keys) - 1)] == query
+
+
+class TripletIndex(object):
+	"""
+	Hashed (head, relation, tail) triplets: each triplet is encoded as a single integer key and the keys are sorted,
+	so that membership of many triplets can be checked at once with a binary search.
+	"""
+	def __init__(self, triplets, n_relations: int, n_entities: int):
+		self.n_relations, self.n_entities = n_relations, n_entities
+		triplets = np.array(list(triplets), dtype=np.int64).reshape(-1, 3)
+		self.keys = np.unique(self._encode(triplets[:, 0], triplets[:, 1], triplets[:, 2]))
+
+	def _encode(self, heads, relations, tails) -> np.ndarray:
+		heads, relations, tails = [np.asarray(x, dtype=np.int64) for x in (heads, relations, tails)]
+		return (heads * self.n_relations + relations) * self.n_entities + tails
+
+	def contains(self, heads, relations, tails) -> np.ndarray:
+		query = self._encode(heads, relations, tails)
+		if len(self.keys) == 0:
+			return np.zeros(query.shape, dtype=bool)
+		pos = np.searchsorted(self.keys, query)
+		return self.keys[np.minimum(pos, len(self.keys) - 1)] == query
+
+
+def reject_sample(rows: np.ndarray, n_neg: int, draw, collide, max_rounds: int = -1, fallback=None) -> np.ndarray:
+	"""
+	Draw [len(rows), n_neg] candidates with draw(size) and redraw, in vectorized rounds, only the entries
+	for which collide(rows, samples) holds (e.g., CSRIndex.contains), until none remains. Each entry ends up
+	drawn from draw's distribution restricted to the non-colliding values of its row, the same as redrawing
+	the entries one by one. After max_rounds rounds (-1 means no limit), the remaining collisions are
+	resolved with fallback.
+	"""
+	rows = np.asarray(rows, dtype=np.int64)
+	samples = draw((len(rows), n_neg))
+	bad_r, bad_c = np.nonzero(collide(rows[:, None], samples))
+	n_round = 0
+	while len(bad_r):
+		if n_round == max_rounds:
+			samples[bad_r, bad_c] = reject_sample(rows[bad_r], 1, fallback, collide)[:, 0]
+			break
+		samples[bad_r, bad_c] = draw(len(bad_r))
+		still = collide(rows[bad_r], samples[bad_r, bad_c])
+		bad_r, bad_c = bad_r[still], bad_c[still]
+		n_round += 1
+	return samples
+
+
+def duplicated(samples: np.ndarray) -> np.ndarray:
+	"""
+	:return: boolean array, True at every repeated value of a row except its first occurrence in sorted order
+	"""
+	order = np.argsort(samples, axis=1, kind='stable')
+	sorted_samples = np.take_along_axis(samples, order, axis=1)
+	dup_sorted = np.zeros(samples.shape, dtype=bool)
+	dup_sorted[:, 1:] = sorted_samples[:, 1:] == sorted_samples[:, :-1]
+	dup = np.zeros(samples.shape, dtype=bool)
+	np.put_along_axis(dup, order, dup_sorted, axis=1)
+	return dup
+
+
+def count_available(index: CSRIndex, rows: np.ndarray, pool: np.ndarray, excluded: np.ndarray = None) -> np.ndarray:
+	"""
+	:return: for each of rows, the number of pool values that are not in its index row (nor equal to excluded[i])
+	"""
+	rows = np.asarray(rows, dtype=np.int64)
+	in_pool = np.zeros(max(index.n_cols, int(pool.max(initial=0)) + 1), dtype=bool)
+	in_pool[pool] = True
+	positions, cols = index.pairs(rows)
+	available = len(np.unique(pool)) - np.bincount(positions, weights=in_pool[cols], minlength=len(rows)).astype(np.int64)
+	if excluded is not None:
+		excluded = np.asarray(excluded, dtype=np.int64)
+		available -= in_pool[excluded] & ~index.contains(rows, excluded)
+	return available
+
+
+def reject_sample_unique(rows: np.ndarray, n_neg: int, draw, collide, n_available: np.ndarray = None) -> np.ndarray:
+	"""
+	Same as reject_sample, but the samples of each row are also distinct from each other (without replacement).
+	:param n_available: number of non-colliding values of each row (e.g., from count_available); rows with fewer
+		than n_neg would never finish, so they are rejected up front
+	"""
+	rows = np.asarray(rows, dtype=np.int64)
+	if n_available is not None and (np.asarray(n_available) < n_neg).any():
+		short = np.nonzero(np.asarray(n_available) < n_neg)[0]
+		raise ValueError('{} rows have fewer than {} values to sample without replacement (e.g., row {}: {}).'.format(
+			len(short), n_neg, rows[short[0]], n_available[short[0]]))
+	samples = draw((len(rows), n_neg))
+	bad = collide(rows[:, None], samples) | duplicated(samples)
+	while bad.any():
+		samples[bad] = draw(int(bad.sum()))
+		bad = collide(rows[:, None], samples) | duplicated(samples)
+	return samples
+
+
+def uniform_draw(low: int, high: int):
+	return lambda size: np.random.randint(low, high, size=size)
+
+
+class AliasTable(object):
+	"""
+	Vose's alias method: O(n) construction, O(1) per draw from a discrete distribution.
+	"""
+	def __init__(self, weights: np.ndarray):
+		n = len(weights)
+		scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+		self.prob, self.alias = np.ones(n), np.arange(n)
+		small, large = list(np.nonzero(scaled < 1)[0]), list(np.nonzero(scaled >= 1)[0])
+		while len(small) and len(large):
+			s, l = small.pop(), large.pop()
+			self.prob[s], self.alias[s] = scaled[s], l
+			scaled[l] = scaled[l] + scaled[s] - 1
+			(small if scaled[l] < 1 else large).append(l)
+		# the leftovers keep probability 1 (up to floating point error)
+
+	def draw(self, size) -> np.ndarray:
+		idx = np.random.randint(len(self.prob), size=size)
+		return np.where(np.random.random(size) < self.prob[idx], idx, self.alias[idx])
+
+
+class UniformSampler(object):
+	"""
+	Negative items drawn uniformly from [1, n_items), excluding the clicked items of each user.
+	"""
+	def __init__(self, n_items: int, index: CSRIndex):
+		self.n_items = n_items
+		self.index = index
+
+	def draw(self, size) -> np.ndarray:
+		return np.random.randint(1, self.n_items, size=size)
+
+	def sample(self, user_ids, n_neg: int) -> np.ndarray:
+		return reject_sample(user_ids, n_neg, self.draw, self.index.contains)
+
+
+class PopularitySampler(UniformSampler):
+	"""
+	Negative items drawn with probability proportional to popularity^alpha through an alias table.
+	As popular items may all be clicked by some user, the rejection falls back to uniform after a few rounds.
+	"""
+	def __init__(self, n_items: int, index: CSRIndex, item_counts: np.ndarray, alpha: float, max_rounds: int = 20):
+		super().__init__(n_items, index)
+		self.max_rounds = max_rounds
+		weights = np.power(np.asarray(item_counts[1:n_items], dtype=np.float64), alpha)
+		self.table = AliasTable(weights) if weights.sum() > 0 else None
+
+	def draw(self, size) -> np.ndarray:
+		if self.table is None:
+			return super().draw(size)
+		return self.table.draw(size) + 1
+
+	def sample(self, user_ids, n_neg: int) -> np.ndarray:
+		return reject_sample(user_ids, n_neg, self.draw, self.index.contains, self.max_rounds, super().draw)
+
+
+class MixedSampler(object):
+	"""
+	The first round(n_neg * ratio) negatives of each instance come from the first sampler, the rest from the second.
+	"""
+	def __init__(self, first, second, ratio: float):
+		self.first, self.second = first, second
+		self.index = first.index
+		self.ratio = ratio
+
+	def sample(self, user_ids, n_neg: int) -> np.ndarray:
+		n_first = int(round(n_neg * self.ratio))
+		return np.concatenate([self.first.sample(user_ids, n_first),
+							   self.second.sample(user_ids, n_neg - n_first)], axis=1)
+
+
+class InBatchSampler(UniformSampler):
+	"""
+	Negative items shared within a batch: each instance takes its negatives from the target items of the batch.
+	Before an epoch only placeholders are produced; the negatives are filled in when collating a batch.
+	"""
+	def __init__(self, n_items: int, index: CSRIndex, max_rounds: int = 5):
+		super().__init__(n_items, index)
+		self.max_rounds = max_rounds
+
+	def sample(self, user_ids, n_neg: int) -> np.ndarray:
+		return np.zeros((len(user_ids), n_neg), dtype=np.int64)
+
+	def sample_in_batch(self, user_ids: np.ndarray, targets: np.ndarray, n_neg: int) -> np.ndarray:
+		draw = lambda size: targets[np.random.randint(len(targets), size=size)]
+		return reject_sample(user_ids, n_neg, draw, self.index.contains, self.max_rounds, self.draw)
+
+
+class HardNegativeSampler(object):
+	"""
+	round(n_neg * ratio) negatives of each instance are drawn from the nearest neighbours of its target item
+	(neighbours: [n_items, top_n] from an item embedding index), excluding the clicked items of the user;
+	the rest come from the base sampler. Rows the neighbourhood cannot serve fall back to uniform negatives.
+	"""
+	def __init__(self, base, index: CSRIndex, neighbours: np.ndarray, targets, ratio: float, max_rounds: int = 5):
+		self.base = base
+		self.index = index
+		self.neighbours = neighbours
+		self.targets = np.asarray(targets, dtype=np.int64)
+		self.ratio = ratio
+		self.max_rounds = max_rounds
+
+	def sample(self, user_ids, n_neg: int) -> np.ndarray:
+		users = np.asarray(user_ids, dtype=np.int64)
+		n_hard = int(round(n_neg * self.ratio))
+		top_n = self.neighbours.shape[1]
+		hard = self.neighbours[self.targets[:, None], np.random.randint(top_n, size=(len(users), n_hard))]
+		bad_r, bad_c = np.nonzero(self.index.contains(users[:, None], hard))
+		for _ in range(self.max_rounds):
+			if not len(bad_r):
+				break
+			hard[bad_r, bad_c] = self.neighbours[self.targets[bad_r], np.random.randint(top_n, size=len(bad_r))]
+			still = self.index.contains(users[bad_r], hard[bad_r, bad_c])
+			bad_r, bad_c = bad_r[still], bad_c[still]
+		if len(bad_r):
+			hard[bad_r, bad_c] = reject_sample(users[bad_r], 1, uniform_draw(1, len(self.neighbours)),
+											   self.index.contains)[:, 0]
+		return np.concatenate([hard, self.base.sample(users, n_neg - n_hard)], axis=1)
+
+
+NEG_SAMPLERS = ['uniform', 'pop', 'inbatch', 'mixed']
+
+
+def build_neg_sampler(name: str, corpus, alpha: float = 0.75, mix_ratio: float = 0.5):
+	"""
+	:param name: one of NEG_SAMPLERS, 'mixed' takes mix_ratio of the negatives from 'pop' and the rest from 'uniform'
+	:param corpus: reader with train_clicked_set and the training data_df (neg items may appear in dev/test set)
+	"""
+	index = CSRIndex(corpus.train_clicked_set, corpus.n_users, corpus.n_items)
+	if name == 'uniform':
+		return UniformSampler(corpus.n_items, index)
+	if name == 'inbatch':
+		return InBatchSampler(corpus.n_items, index)
+	item_counts = np.bincount(np.asarray(corpus.data_df['train']['item_id'], dtype=np.int64), minlength=corpus.n_items)
+	pop_sampler = PopularitySampler(corpus.n_items, index, item_counts, alpha)
+	if name == 'pop':
+		return pop_sampler
+	if name == 'mixed':
+		return MixedSampler(pop_sampler, UniformSampler(corpus.n_items, index), mix_ratio)
+	raise ValueError('Undefined negative sampler: {}.'.format(name))
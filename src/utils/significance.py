@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+from scipy import stats
+from typing import Dict
+
+from utils import utils
+from utils.metrics import rank_metric_rows, ctr_metric_rows
+
+# Per-row results of one split of one run, written by the runners (--save_rows) and compared offline, e.g.:
+#   a, b = load_rows(path_a), load_rows(path_b)
+#   compare(row_metrics(a, [10], ['NDCG']), row_metrics(b, [10], ['NDCG']))
+
+
+def save_rows(path: str, rows: Dict[str, np.ndarray]):
+	"""
+	Save the per-row vectors of a split as a compressed npz (e.g., user_id and gt_rank as int32).
+	"""
+	utils.save_npz(path, rows, compress=True)
+
+
+def load_rows(path: str) -> Dict[str, np.ndarray]:
+	return utils.load_npz(path)
+
+
+def row_metrics(rows: Dict[str, np.ndarray], topk: list, metrics: list) -> Dict[str, np.ndarray]:
+	"""
+	Per-row metric vectors from saved rows: ground-truth ranks (top-k ranking), predictions and labels (CTR),
+	or the metric vectors themselves (impression ranking).
+	"""
+	if 'gt_rank' in rows:
+		return rank_metric_rows(rows['gt_rank'], topk, metrics)
+	if 'label' in rows:
+		return ctr_metric_rows(rows['prediction'], rows['label'], metrics)
+	return {key: value for key, value in rows.items() if key != 'user_id'}
+
+
+def paired_bootstrap(a: np.ndarray, b: np.ndarray, n_resamples: int = 10000, alpha: float = 0.05,
+					 seed: int = 0, chunk_size: int = 2 ** 24) -> dict:
+	"""
+	Paired bootstrap of the mean difference a - b over the same rows. Resamples are drawn as index matrices,
+	a chunk of resamples at a time (about chunk_size indices).
+	:return: dict of the mean difference, its (1 - alpha) percentile interval and the two-sided p-value
+	"""
+	diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+	n = len(diff)
+	rng = np.random.default_rng(seed)
+	means = np.empty(n_resamples)
+	step = max(1, chunk_size // max(n, 1))
+	for start in range(0, n_resamples, step):
+		size = min(step, n_resamples - start)
+		means[start:start + size] = diff[rng.integers(0, n, size=(size, n))].mean(axis=1)
+	low, high = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+	p_value = min(1., 2 * min((means <= 0).mean(), (means >= 0).mean()))
+	return {'diff': diff.mean(), 'low': low, 'high': high, 'p': p_value}
+
+
+def paired_t_test(a: np.ndarray, b: np.ndarray) -> dict:
+	diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+	std = diff.std(ddof=1) if len(diff) > 1 else 0.
+	if std == 0:
+		return {'diff': diff.mean(), 't': 0., 'p': 1. if diff.mean() == 0 else 0.}
+	t = diff.mean() / (std / np.sqrt(len(diff)))
+	return {'diff': diff.mean(), 't': t, 'p': 2 * stats.t.sf(abs(t), len(diff) - 1)}
+
+
+def compare(metrics_a: Dict[str, np.ndarray], metrics_b: Dict[str, np.ndarray], **kwargs) -> Dict[str, dict]:
+	"""
+	Paired tests of every metric shared by two runs on the same split (rows must be aligned).
+	:return: dict of metric -> {diff, low, high, p (bootstrap), t, p_t (t-test)}
+	"""
+	results = dict()
+	for key in metrics_a:
+		if key not in metrics_b:
+			continue
+		if len(metrics_a[key]) != len(metrics_b[key]):
+			raise ValueError('Rows of {} are not aligned: {} vs {}.'.format(key, len(metrics_a[key]), len(metrics_b[key])))
+		result = paired_bootstrap(metrics_a[key], metrics_b[key], **kwargs)
+		t_test = paired_t_test(metrics_a[key], metrics_b[key])
+		result['t'], result['p_t'] = t_test['t'], t_test['p']
+		results[key] = result
+	return results
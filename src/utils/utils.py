@@ -1,13 +1,15 @@
 # -*- coding: UTF-8 -*-
 
 import os
+import copy
 import random
+import zipfile
 import logging
 import torch
 import datetime
 import numpy as np
 import pandas as pd
-from typing import List, Dict, NoReturn, Any
+from typing import List, Dict, NoReturn, Any, Callable
 
 
 def init_seed(seed):
@@ -27,6 +29,26 @@ def df_to_dict(df: pd.DataFrame) -> dict:
 	return res
 
 
+def take_rows(column, rows: np.ndarray):
+	if isinstance(column, list):
+		return [column[i] for i in rows]
+	return column[rows]
+
+
+def select_rows(dataset, rows: np.ndarray):
+	"""
+	A shallow copy of a dataset restricted to the given rows: data columns, buffered feed dicts and
+	row-aligned caches (e.g., the ranker cache of rerankers) are re-indexed alike.
+	"""
+	subset = copy.copy(dataset)
+	subset.data = {k: take_rows(v, rows) for k, v in dataset.data.items()}
+	if len(dataset.buffer_dict):
+		subset.buffer_dict = {i: dataset.buffer_dict[row] for i, row in enumerate(rows)}
+	if getattr(dataset, 'ranker_cache', None) is not None:
+		subset.ranker_cache = {k: v[rows] for k, v in dataset.ranker_cache.items()}
+	return subset
+
+
 def batch_to_gpu(batch: dict, device) -> dict:
 	for c in batch:
 		if type(batch[c]) is torch.Tensor:
@@ -100,6 +122,54 @@ def check_dir(file_name: str):
 		os.makedirs(dir_path)
 
 
+def save_npz(file_name: str, arrays: Dict[str, np.ndarray], compress: bool = False):
+	"""
+	Save named columns to an npz file, replaced atomically (readers never see a half-written file).
+	"""
+	check_dir(file_name)
+	tmp_name = file_name + '.tmp.npz'
+	(np.savez_compressed if compress else np.savez)(tmp_name, **arrays)
+	os.replace(tmp_name, file_name)
+
+
+def save_npz_chunks(file_name: str, n_rows: int, columns: Dict[str, Callable[[int, int], np.ndarray]],
+					chunk_size: int = 65536, compress: bool = False):
+	"""
+	Save named columns to an npz file one chunk of rows at a time: columns[name](start, end) returns the rows
+	[start, end) of a column, streamed into its .npy member, so that only one chunk is in memory at a time.
+	Readable with np.load / load_npz, and replaced atomically like save_npz.
+	"""
+	check_dir(file_name)
+	tmp_name = file_name + '.tmp.npz'
+	with zipfile.ZipFile(tmp_name, 'w', zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, allowZip64=True) as zf:
+		for name, column in columns.items():
+			with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+				for start in range(0, max(n_rows, 1), chunk_size):  # an empty column still writes its header
+					chunk = np.ascontiguousarray(column(start, min(start + chunk_size, n_rows)))
+					if start == 0:  # the header holds the shape of the whole column
+						np.lib.format.write_array_header_1_0(f, {
+							'descr': np.lib.format.dtype_to_descr(chunk.dtype), 'fortran_order': False,
+							'shape': (n_rows,) + chunk.shape[1:]})
+					f.write(chunk.tobytes())
+	os.replace(tmp_name, file_name)
+
+
+def pad_rows(rows: list, length: int, dtype=np.int64) -> np.ndarray:
+	"""
+	Ragged rows (lists or arrays) cut to length and padded with 0 into a [len(rows), length] array.
+	"""
+	lengths = np.array([min(len(row), length) for row in rows], dtype=int)
+	padded = np.zeros((len(rows), length), dtype=dtype)
+	if lengths.sum() > 0:
+		padded[np.arange(length) < lengths[:, None]] = np.concatenate([np.asarray(row[:length]) for row in rows])
+	return padded
+
+
+def load_npz(file_name: str) -> Dict[str, np.ndarray]:
+	with np.load(file_name) as f:
+		return {key: f[key] for key in f.files}
+
+
 def non_increasing(lst: list) -> bool:
 	return all(x >= y for x, y in zip([lst[0]]*(len(lst)-1), lst[1:])) # update the calculation of non_increasing to fit ealry stopping, 2023.5.14, Jiayu Li
 
@@ -0,0 +1,54 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import subprocess
+import numpy as np
+import pandas as pd
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+
+@pytest.fixture
+def toy_data(tmp_path):
+	"""
+	A tiny top-k dataset in the format of the readers: 30 users with 6 training items each,
+	one dev and one test item with 5 negative items each.
+	"""
+	rng = np.random.RandomState(0)
+	rows = {'train': list(), 'dev': list(), 'test': list()}
+	all_items = np.arange(1, 41)
+	for user in range(1, 31):
+		items = rng.choice(all_items, 8, replace=False)
+		for t, item in enumerate(items[:6]):
+			rows['train'].append((user, item, t))
+		for key, item, t in [('dev', items[6], 6), ('test', items[7], 7)]:
+			neg_items = rng.choice(np.setdiff1d(all_items, items), 5, replace=False).tolist()
+			rows[key].append((user, item, t, str(neg_items)))
+	data_dir = tmp_path / 'data' / 'Toy'
+	data_dir.mkdir(parents=True)
+	pd.DataFrame(rows['train'], columns=['user_id', 'item_id', 'time']).to_csv(
+		data_dir / 'train.csv', sep='\t', index=False)
+	for key in ['dev', 'test']:
+		pd.DataFrame(rows[key], columns=['user_id', 'item_id', 'time', 'neg_items']).to_csv(
+			data_dir / (key + '.csv'), sep='\t', index=False)
+	return tmp_path
+
+
+@pytest.fixture
+def run_main(toy_data):
+	"""
+	Run main.py on the toy dataset (BPRMF on CPU) in its own process, and return the text of its log file.
+	"""
+	def run(name: str, *args) -> str:
+		log_file = str(toy_data / (name + '.txt'))
+		command = [sys.executable, 'main.py', '--model_name', 'BPRMF', '--path', str(toy_data / 'data') + os.sep,
+				   '--dataset', 'Toy', '--gpu', '', '--num_workers', '0', '--emb_size', '8', '--batch_size', '16',
+				   '--save_final_results', '0', '--log_file', log_file,
+				   '--model_path', str(toy_data / (name + '.pt'))] + [str(arg) for arg in args]
+		result = subprocess.run(command, cwd=SRC_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=600)
+		assert result.returncode == 0, result.stdout.decode(errors='replace')[-3000:]
+		with open(log_file) as f:
+			return f.read()
+	return run
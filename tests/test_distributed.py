@@ -0,0 +1,14 @@
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+pytest.importorskip('torch')
+
+
+@pytest.mark.parametrize('sparse_emb', [0, 1])
+def test_data_parallel_training(run_main, sparse_emb):
+	# two gloo worker processes train on their shards, rank 0 evaluates and saves the best model
+	log = run_main('dist{}'.format(sparse_emb), '--epoch', 2, '--n_procs', 2, '--sparse_emb', sparse_emb)
+	assert 'Epoch 2 ' in log
+	assert 'Best Iter(dev)' in log
+	assert 'Test After Training' in log
@@ -0,0 +1,30 @@
+# -*- coding: UTF-8 -*-
+
+import re
+import pytest
+
+torch = pytest.importorskip('torch')
+
+
+def epoch_results(log: str) -> dict:
+	# epoch -> loss and dev results, without timings
+	return {int(epoch): (loss, dev) for epoch, loss, dev in
+			re.findall(r'Epoch (\d+)\s+loss=(\S+) \[.*?\]\s+dev=\((.*?)\)', log)}
+
+
+def test_resume_matches_straight_run(run_main, toy_data):
+	straight = run_main('straight', '--epoch', 4, '--save_state', 1)
+	run_main('resumed', '--epoch', 2, '--save_state', 1)
+	resumed = run_main('resumed', '--epoch', 4, '--save_state', 1, '--load', 1)
+	assert 'Resume training state' in resumed and '(epoch 2)' in resumed
+
+	straight_results, resumed_results = epoch_results(straight), epoch_results(resumed)
+	assert sorted(straight_results) == [1, 2, 3, 4]
+	for epoch in [3, 4]:
+		assert resumed_results[epoch] == straight_results[epoch]
+
+	straight_state = torch.load(str(toy_data / 'straight.state.pt'), weights_only=False)
+	resumed_state = torch.load(str(toy_data / 'resumed.state.pt'), weights_only=False)
+	assert straight_state['epoch'] == resumed_state['epoch'] == 4
+	for name, weight in straight_state['model'].items():
+		assert torch.equal(weight, resumed_state['model'][name]), name